@@ -2,30 +2,37 @@
 """
 This is the ami module which is contains the bits that are used by all
 libraries and binaries
+
+The heavier dependencies (yaml, pymongo, setproctitle) are imported when
+they are first needed, so tools start quickly.
 """
-import yaml
 from pathlib import Path
 import sys
 import logging.config
 import logging
 import logging.handlers
 import fcntl
-from pymongo import MongoClient, ASCENDING, DESCENDING
+import hashlib
+import json
 import os
-import setproctitle
+
+# pymongo's sort directions, so the other modules don't need to import it
+ASCENDING = 1
+DESCENDING = -1
 
 class Ami:
     def __init__(self, application=None, inherit_logging=False):
         if application is None:
             application = Path(sys.argv[0]).stem
         self.application = application
-        self.set_proc_title()
+        # the process title is set when the database is first used (or by
+        # set_proc_title), so setproctitle isn't imported just to start up
+        self.titled = False
 
         # set up and load configuration stuff
         self.root = Path(sys.path[0], "..").resolve()
         self.config_path = Path(self.root, "etc")
-        with open(self.config_path.joinpath("ami.conf")) as f:
-            self.config = yaml.safe_load(f)        
+        self.config = self.load_config()
 
         # configure standard logging
         if not inherit_logging:
@@ -38,7 +45,44 @@ class Ami:
         sys.db = None   
 
 
+    def load_config(self):
+        """Load the configuration file.  The parsed configuration is cached
+           as JSON in var/ along with the sha256 of the file it came from, so
+           yaml isn't needed until the file changes"""
+        conffile = self.config_path.joinpath("ami.conf")
+        cachefile = Path(self.root, "var", "ami.conf.cache")
+        with open(conffile, "rb") as f:
+            text = f.read()
+        digest = hashlib.sha256(text).hexdigest()
+        try:
+            with open(cachefile) as f:
+                cached = json.load(f)
+            if cached['sha256'] == digest:
+                return cached['config']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        import yaml
+        config = yaml.safe_load(text)
+        try:
+            # only cache what survives the trip through JSON unchanged
+            data = json.dumps({'sha256': digest, 'config': config})
+            if json.loads(data)['config'] != config:
+                return config
+            # the config has credentials, so keep the cache private
+            tmpfile = cachefile.with_name(f"{cachefile.name}.{os.getpid()}")
+            with os.fdopen(os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                f.write(data)
+            os.replace(tmpfile, cachefile)
+        except (OSError, TypeError, ValueError) as e:
+            logging.debug(f"Cannot cache the configuration: {e}")
+        return config
+
+
     def set_proc_title(self, application=None, action=None):
+        "Set the process title, which is the application name unless given, and the action"
+        import setproctitle
+        self.titled = True
         if application is None:
             application = self.application
         if action is None:
@@ -60,21 +104,70 @@ class Ami:
         "Get a DB object that is fully configured"
         # intialize a new db connection if we don't have one or
         # the PID is different from the one we already have
+        if not self.titled:
+            self.set_proc_title()
         if sys.db is None or sys.db[0] != os.getpid():
+            from pymongo import MongoClient
             mdb = MongoClient(**self.config['mongodb']['connection'])
             mdb = mdb.get_database(self.config['mongodb']['database'])            
             sys.db = (os.getpid(), mdb)
 
             # to database setup here
-            if 'packages' not in mdb.list_collection_names():
+            collections = mdb.list_collection_names()
+            if 'packages' not in collections:
                 logging.info("Creating database collections and indexes")
                 mdb.create_collection('packages')
                 mdb.packages.create_index('id')
                 mdb.packages.create_index('timestamp')
                 mdb.packages.create_index([('id', ASCENDING), ('timestamp', DESCENDING)])
+            if 'migrations' not in collections:
+                # one time migrations.  The collection records that they
+                # have been done, so they cost nothing once it exists.
+                if 'latest_1_state_1_state_change_1' not in mdb.packages.index_information():
+                    # documents from before the latest flag
+                    Ami.mark_latest(mdb)
+                    mdb.packages.create_index([('latest', ASCENDING), ('state', ASCENDING), ('state_change', ASCENDING)])
+                from pymongo.errors import CollectionInvalid
+                try:
+                    mdb.create_collection('migrations')
+                except CollectionInvalid:
+                    # someone else finished first
+                    pass
+            if 'checksums' not in collections:
+                logging.info("Creating checksum ledger collection and indexes")
+                mdb.create_collection('checksums')
+                mdb.checksums.create_index([('package', ASCENDING), ('path', ASCENDING)], unique=True)
+            if 'package_logs' not in collections:
+                logging.info("Creating package log collection and indexes")
+                mdb.create_collection('package_logs')
+                mdb.package_logs.create_index([('package', ASCENDING), ('created', ASCENDING), ('_id', ASCENDING)])
+                if self.config['mongodb'].get('log_retention'):
+                    mdb.package_logs.create_index('created', expireAfterSeconds=self.config['mongodb']['log_retention'] * 86400)
 
         return sys.db[1]
 
+    @staticmethod
+    def mark_latest(mdb):
+        """Set the latest flag on the package documents which don't have one
+           yet: true for the newest version of a package, false for the rest.
+           A flag which is already set is never changed, so this is safe to
+           run while packages are being created"""
+        ids = mdb.packages.distinct('id', {'latest': {'$exists': False}})
+        if ids:
+            logging.info(f"Marking the latest version of {len(ids)} packages")
+        for i in range(0, len(ids), 1000):
+            batch = ids[i:i + 1000]
+            res = mdb.packages.aggregate([
+                {'$match': {'id': {'$in': batch}}},
+                {'$sort': {'timestamp': -1}},
+                {'$group': {'_id': '$id', 'latest': {'$first': '$_id'}}},
+            ], allowDiskUse=True)
+            latest = [x['latest'] for x in res]
+            mdb.packages.update_many({'_id': {'$in': latest}, 'latest': {'$exists': False}},
+                                     {'$set': {'latest': True}})
+            mdb.packages.update_many({'id': {'$in': batch}, 'latest': {'$exists': False}},
+                                     {'$set': {'latest': False}})
+
     def get_directory(self, name):
         "Get a directory path object from the config file 'directories' section"
         return Path(self.resolve_path(self.config['directories'][name]))
@@ -0,0 +1,110 @@
+"""
+Checksum ledger for package files.
+
+Every file that gets hashed while a package moves through the workflow
+has its checksum recorded here, along with enough stat information to
+know if the file has changed since.  Later stages can pull the checksum
+from the ledger rather than reading the whole file again.
+"""
+from pathlib import Path
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger()
+
+
+# Reads are done in large, page-aligned blocks into a reused buffer
+BLOCKSIZE = 8 * 1024 * 1024
+
+
+def hash_file(path: Path, algorithms=('md5',), blocksize=BLOCKSIZE):
+    """Compute several digests for a file while only reading it once.
+       Returns a dict of algorithm -> hex digest"""
+    hashers = {a: hashlib.new(a) for a in algorithms}
+    buffer = bytearray(blocksize)
+    view = memoryview(buffer)
+    with open(path, mode="rb", buffering=0) as h:
+        while True:
+            count = h.readinto(buffer)
+            if not count:
+                break
+            for m in hashers.values():
+                m.update(view[:count])
+    return {a: m.hexdigest() for a, m in hashers.items()}
+
+
+def copy_and_hash(src, dst, algorithms=('md5',), blocksize=BLOCKSIZE, abort=None):
+    """Copy one file object to another, computing digests of the data as it
+       goes by.  If the abort event is set the copy stops with an
+       InterruptedError.  Returns a dict of algorithm -> hex digest"""
+    hashers = {a: hashlib.new(a) for a in algorithms}
+    buffer = bytearray(blocksize)
+    view = memoryview(buffer)
+    while True:
+        if abort is not None and abort.is_set():
+            raise InterruptedError("Copy was aborted")
+        count = src.readinto(buffer)
+        if not count:
+            break
+        dst.write(view[:count])
+        for m in hashers.values():
+            m.update(view[:count])
+    return {a: m.hexdigest() for a, m in hashers.items()}
+
+
+def md5_file(path: Path):
+    "Compute the md5 of a file"
+    return hash_file(path)['md5']
+
+
+def file_signature(path: Path):
+    "The stat values used to decide if a file has changed since it was hashed"
+    s = os.stat(path)
+    return {'size': s.st_size, 'mtime': s.st_mtime_ns, 'inode': s.st_ino}
+
+
+class ChecksumLedger:
+    """
+    Checksums for the files in a package, stored in the 'checksums'
+    collection.  Entries are keyed by the package document _id and the
+    path relative to the package's workspace directory.  An entry is only
+    considered valid if the size, mtime and inode of the file still match
+    what was recorded.
+    """
+    def __init__(self, ami, pkg):
+        self.ami = ami
+        self.db = ami.get_db()
+        self.pkg_id = pkg.data['_id']
+
+    def record(self, relpath, path: Path, md5, stat=None):
+        """Record the md5 for a file.  If the stat information was captured
+           before the file was hashed, pass it in, otherwise it is taken now"""
+        entry = dict(stat) if stat is not None else file_signature(path)
+        entry['md5'] = md5.lower()
+        self.db.checksums.update_one({'package': self.pkg_id, 'path': str(relpath)},
+                                     {'$set': entry}, upsert=True)
+
+    def lookup(self, relpath, path: Path):
+        "Get the recorded md5 for a file, or None if it is unknown or has changed"
+        entry = self.db.checksums.find_one({'package': self.pkg_id, 'path': str(relpath)})
+        if entry is None:
+            return None
+        try:
+            current = file_signature(path)
+        except FileNotFoundError:
+            return None
+        for k, v in current.items():
+            if entry.get(k) != v:
+                logger.debug(f"Checksum ledger entry for {relpath} is stale: {k} changed")
+                return None
+        return entry['md5']
+
+    def md5(self, relpath, path: Path):
+        "Get the md5 from the ledger, computing (and recording) it if needed"
+        md5 = self.lookup(relpath, path)
+        if md5 is None:
+            stat = file_signature(path)
+            md5 = md5_file(path)
+            self.record(relpath, path, md5, stat)
+        return md5
@@ -0,0 +1,133 @@
+"""
+Content-addressed cache of transcoded derivatives.
+
+A derivative is determined by the source content, the ffmpeg arguments,
+the ffmpeg build and the way ffmpeg was run (one rendition at a time, or
+all of them from a single decode), so those are hashed together for the
+cache key.
+Reprocessing a package whose masters and profiles haven't changed can
+then link the old derivatives back into place instead of transcoding.
+
+Each entry is a pair of files named for the key: the mp4 and a JSON
+sidecar with the ffprobe XML and the md5 of the mp4.  The access time of
+the mp4 is updated on every hit and the least recently used entries are
+removed when the cache is larger than the configured size.  The mtime is
+never changed since the derivatives in the workspace may be hardlinks to
+the cache entries and the checksum ledger keys on it.  For the same
+reason, a derivative in the workspace must be unlinked (never overwritten)
+before it is made again.
+"""
+from pathlib import Path
+from functools import lru_cache
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger()
+
+
+@lru_cache(maxsize=None)
+def ffmpeg_version(ffmpeg):
+    "The version line from an ffmpeg binary"
+    p = subprocess.run([ffmpeg, '-version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                       encoding='utf-8')
+    if p.returncode != 0:
+        raise Exception(f"Cannot get the version of {ffmpeg}: return code {p.returncode}")
+    return p.stdout.splitlines()[0].strip()
+
+
+def link_or_copy(src: Path, dst: Path):
+    "Hardlink a file into place, copying it if the link can't be made"
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class DerivativeCache:
+    "A size-bounded cache of derivatives in a directory"
+    def __init__(self, directory: Path, max_size):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(source_md5, profile, version, mode=None):
+        """The cache key for a source, an ffmpeg argument string, an ffmpeg
+           version and an encode mode (None for one rendition at a time, which
+           keeps the keys from before there were modes)"""
+        h = hashlib.sha256()
+        for part in (source_md5.lower(), " ".join(profile.split()), version, *([mode] if mode else [])):
+            h.update(part.encode('utf-8') + b'\0')
+        return h.hexdigest()
+
+    def _paths(self, key):
+        base = self.directory / key[:2] / key
+        return base.with_suffix(".mp4"), base.with_suffix(".json")
+
+    def fetch(self, key, outfile: Path):
+        """Put the cached derivative for a key at outfile.  Returns the
+           stored data (ffprobe, md5) or None if the key isn't cached"""
+        mp4, sidecar = self._paths(key)
+        try:
+            with open(sidecar) as f:
+                data = json.load(f)
+            if outfile.exists():
+                outfile.unlink()
+            link_or_copy(mp4, outfile)
+        except (FileNotFoundError, ValueError):
+            return None
+        # mark it as recently used, leaving the mtime alone
+        s = os.stat(mp4)
+        os.utime(mp4, ns=(time.time_ns(), s.st_mtime_ns))
+        return data
+
+    def store(self, key, outfile: Path, ffprobe, md5):
+        "Add a derivative to the cache, evicting old entries to make room"
+        mp4, sidecar = self._paths(key)
+        mp4.parent.mkdir(exist_ok=True)
+        # stage under temporary names so a partial entry is never visible.
+        # Threads in the same process can store the same key at once.
+        tmp = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        tmp_mp4 = mp4.with_name(mp4.name + tmp)
+        tmp_sidecar = sidecar.with_name(sidecar.name + tmp)
+        try:
+            link_or_copy(outfile, tmp_mp4)
+            with open(tmp_sidecar, "w") as f:
+                json.dump({'ffprobe': ffprobe, 'md5': md5}, f)
+            os.replace(tmp_mp4, mp4)
+            os.replace(tmp_sidecar, sidecar)
+        finally:
+            for f in (tmp_mp4, tmp_sidecar):
+                if f.exists():
+                    f.unlink()
+        self.evict()
+
+    def evict(self):
+        "Remove the least recently used entries until the cache fits"
+        with open(self.directory / ".lock", "w") as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for mp4 in self.directory.glob("??/*.mp4"):
+                try:
+                    s = mp4.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((s.st_atime_ns, s.st_size, mp4))
+                total += s.st_size
+            entries.sort()
+            for _, size, mp4 in entries:
+                if total <= self.max_size:
+                    break
+                logger.debug(f"Evicting {mp4.stem} from the derivative cache")
+                for f in (mp4.with_suffix(".json"), mp4):
+                    if f.exists():
+                        f.unlink()
+                total -= size
@@ -1,7 +1,12 @@
 from pathlib import Path
 import logging
 import csv
+import os
+import sqlite3
+import threading
+import time
 import xml.etree.ElementTree as ET
+from .mets import Mets
 
 logger = logging.getLogger()
 
@@ -11,26 +16,112 @@ Lookup title metadata.
 
 
 class Metadata:
-    "Source of id to title lookup files"
-    def __init__(self, metadir: Path):
+    """
+    Source of id to title lookup files.
+
+    The spreadsheets are indexed into an SQLite file (by default in the 
+    metadata directory) which is shared by every process.  A spreadsheet
+    is only re-read when its mtime or size changes, and lookups only check
+    the spreadsheets for changes every refresh_interval seconds.
+    """
+    def __init__(self, metadir: Path, index: Path = None, refresh_interval=60):
         self.metadir = metadir
+        self.index = index if index is not None else metadir / ".title_index.sqlite"
+        self.refresh_interval = refresh_interval
+        self.refreshed = None
+
+    def _connect(self):
+        "Get the (per-process) connection to the index, creating it if needed"
+        key = (str(self.index), os.getpid())
+        if key not in _connections:
+            db = sqlite3.connect(str(self.index), timeout=60, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, mtime INTEGER, size INTEGER)")
+            db.execute("CREATE TABLE IF NOT EXISTS titles (barcode TEXT, title TEXT, file TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS titles_barcode ON titles (barcode)")
+            db.execute("CREATE INDEX IF NOT EXISTS titles_file ON titles (file)")
+            _connections[key] = (db, threading.Lock())
+        return _connections[key]
+
+    def _changes(self, db):
+        "Get the spreadsheets that have changed (or gone away) since they were indexed"
+        current = {}
+        for csvfile in self.metadir.glob("*.csv"):
+            s = csvfile.stat()
+            current[csvfile.name] = (s.st_mtime_ns, s.st_size)
+        indexed = {name: (mtime, size) for name, mtime, size in db.execute("SELECT name, mtime, size FROM files")}
+        changed = {name: sig for name, sig in current.items() if indexed.get(name) != sig}
+        removed = [name for name in indexed if name not in current]
+        return changed, removed
+
+    def refresh(self):
+        "Bring the index up to date with the spreadsheets"
+        db, lock = self._connect()
+        with lock:
+            checked = time.monotonic()
+            changed, removed = self._changes(db)
+            if not (changed or removed):
+                self.refreshed = checked
+                return
+            # take the write lock and look again, since another process
+            # may have beaten us to it.
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                changed, removed = self._changes(db)
+                for name in [*removed, *changed]:
+                    db.execute("DELETE FROM titles WHERE file = ?", (name,))
+                    db.execute("DELETE FROM files WHERE name = ?", (name,))
+                for name, (mtime, size) in changed.items():
+                    logger.info(f"Indexing titles in {name}")
+                    db.executemany("INSERT INTO titles (barcode, title, file) VALUES (?, ?, ?)",
+                                   [(barcode, title, name) for barcode, title in self._read_titles(self.metadir / name)])
+                    db.execute("INSERT INTO files (name, mtime, size) VALUES (?, ?, ?)", (name, mtime, size))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            self.refreshed = checked
+            self._report_duplicates(db)
+
+    @staticmethod
+    def _read_titles(csvfile: Path):
+        "Read the barcode/title pairs from a spreadsheet"
+        with open(csvfile) as f:
+            csvreader = csv.DictReader(f)
+            if 'Barcode' not in (csvreader.fieldnames or []):
+                logger.warning(f"Metadata file {csvfile!s} doesn't have a 'Barcode' column. Skipping")
+                return []
+            if 'Title' not in csvreader.fieldnames:
+                logger.warning(f"Metadata file {csvfile!s} doesn't have a 'Title' column. Skipping")
+                return []
+            return [(row['Barcode'], row['Title']) for row in csvreader]
+
+    @staticmethod
+    def _report_duplicates(db):
+        "Log the barcodes which show up more than once"
+        for barcode, count, titles, files in db.execute(
+                "SELECT barcode, COUNT(*), COUNT(DISTINCT title), GROUP_CONCAT(DISTINCT file) FROM titles GROUP BY barcode HAVING COUNT(*) > 1"):
+            if titles > 1:
+                logger.warning(f"Barcode {barcode} has {titles} conflicting titles in {files}")
+            else:
+                logger.info(f"Barcode {barcode} is listed {count} times in {files}")
 
     def lookup_title(self, barcode):
         "Lookup the title from the spreadsheets via a barcode"
         logging.info(f"Lookup title in {self.metadir!s}")
-        for csvfile in self.metadir.glob("*.csv"):
-            with open(csvfile) as f:
-                csvreader = csv.DictReader(f)
-                if 'Barcode' not in csvreader.fieldnames:
-                    logger.warning(f"Metadata file {csvfile!s} doesn't have a 'Barcode' column. Skipping")
-                    continue
-                if 'Title' not in csvreader.fieldnames:
-                    logger.warning(f"Metadata file {csvfile!s} doesn't have a 'Title' column. Skipping")
-                    continue
-                for row in csvreader:
-                    if row['Barcode'] == barcode:
-                        return row['Title']
-        raise KeyError(f"No title metadata for barcode {barcode}")
+        if self.refreshed is None or time.monotonic() - self.refreshed >= self.refresh_interval:
+            self.refresh()
+        db, lock = self._connect()
+        with lock:
+            row = db.execute("SELECT title FROM titles WHERE barcode = ? ORDER BY file, rowid LIMIT 1", (barcode,)).fetchone()
+        if row is None:
+            raise KeyError(f"No title metadata for barcode {barcode}")
+        return row[0]
+
+
+# index connections, keyed by index path and pid
+_connections = {}
 
 
 def denamespace(xmlfile: Path):    
@@ -47,88 +138,162 @@ def denamespace(xmlfile: Path):
                     del el.attrib[at]
     return it.root
         
+def stream_find(xmlfile: Path, path, predicate=None):
+    """Find the first element matching a path (from the root) without building
+       the whole tree.  The path is a list of (tag, {attribute: value}) 
+       pairs, without namespaces, with the first entry being the root.  A tag
+       of None matches any element.  Elements which can't contain a match
+       are discarded as the file is read."""
+    stack = []
+    for event, el in ET.iterparse(str(xmlfile), events=('start', 'end')):
+        if event == 'start':
+            stack.append(el)
+            continue
+        depth = len(stack)
+        if depth == len(path) and all((tag is None or _local(e.tag) == tag) and all(_local_attrib(e).get(k) == v for k, v in attrs.items())
+                                      for e, (tag, attrs) in zip(stack, path)):
+            if predicate is None or predicate(el):
+                return el
+        stack.pop()
+        if depth <= len(path):
+            el.clear()
+    return None
+
+
+def _local(tag):
+    return tag.rpartition('}')[2]
+
+
+def _local_attrib(el):
+    return {_local(k): v for k, v in el.attrib.items()}
+
+
+def marc_date_issued(marcfile: Path, default=None):
+    "Get the issue date from the first personal name (100) field of a MARC file"
+    def personal_name(el):
+        attrib = _local_attrib(el)
+        return attrib.get('tag') == '100' and attrib.get('ind1', '') == '1' and attrib.get('ind2', '') == ' '
+
+    marc100 = stream_find(marcfile, [(None, {}), ('record', {}), ('datafield', {})], personal_name)
+    if marc100 is None:
+        return default
+    logging.debug(ET.tostring(marc100))
+    subfield = [x for x in marc100 if _local(x.tag) == 'subfield' and _local_attrib(x).get('code') == 'd'][0]
+    return subfield.text.split('-', 1)[0]
+
+
+def ead_date_issued(eadfile: Path):
+    "Get the issue date from the collection unitdate in an EAD file"
+    unitdate = stream_find(eadfile, [(None, {}), ('archdesc', {'level': 'collection'}), ('did', {}),
+                                     ('unittitle', {}), ('unitdate', {})])
+    if unitdate is None:
+        raise KeyError(f"No collection unitdate in {eadfile!s}")
+    return unitdate.text.split('-', 1)[0]
+
+        
 def prettify(element, indent='  '):
-    # alas we're on 3.8, so ElementTree.indent isn't available.  Stole this from stack overflow.
-    queue = [(0, element)]  # (level, element)
-    while queue:
-        level, element = queue.pop(0)
+    # alas we're on 3.8, so ElementTree.indent isn't available.  Stole this from stack overflow,
+    # but use the end of the list as the front of the queue so it isn't quadratic.
+    stack = [(0, element)]  # (level, element), next element is at the end
+    while stack:
+        level, element = stack.pop()
         children = [(level + 1, child) for child in list(element)]
         if children:
             element.text = '\n' + indent * (level+1)  # for child open
-        if queue:
-            element.tail = '\n' + indent * queue[0][0]  # for sibling open
+        if stack:
+            element.tail = '\n' + indent * stack[-1][0]  # for sibling open
         else:
             element.tail = '\n' + indent * (level-1)  # for parent close
-        queue[0:0] = children  # prepend so children come before siblings
+        stack.extend(reversed(children))  # so children come before siblings
+
 
+class ModsEngine:
+    """
+    Generate MODS for packages.  One engine can be used for any number of
+    packages, so the title index connection is only set up once.
+    """
+    def __init__(self, metadir: Path):
+        self.metadata = Metadata(metadir)
 
-def avalon_mods(barcode, metadir, metsfile: Path, marcfile: Path, eadfile: Path, has_video=False):
-    "Generate an avalon-compatible MODS file"
+    def avalon_mods(self, barcode, metsfile, marcfile: Path, eadfile: Path, has_video=False):
+        "Generate an avalon-compatible MODS file.  The metsfile can be a path or a parsed Mets"
     
-    metadata = {'title': Metadata(metadir).lookup_title(barcode),
-                'identifiers': [],
-                'dateissued': '19uu'
-    }
+        metadata = {'title': self.metadata.lookup_title(barcode),
+                    'identifiers': [],
+                    'dateissued': '19uu'
+        }
     
-    # identifiers from mets
-    tree = denamespace(metsfile)    
-    for xlink in tree.findall("dmdSec[@ID='DMD1']/mdRef"):
-        metadata['identifiers'].append([xlink.attrib.get('MDTYPE', 'Unknown'), xlink.attrib['href']])
-
-    if marcfile and marcfile.exists():
-        tree = denamespace(marcfile)
-        for marc100 in tree.findall("record/datafield[@tag='100']"):
-            logging.debug(ET.tostring(marc100))
-            if marc100.attrib.get('ind1', '') == '1' and marc100.attrib.get('ind2', '') == ' ':        
-                metadata['dateissued'] = marc100.find("subfield[@code='d']").text.split('-', 1)[0]                
-                break    
-
-    elif eadfile and eadfile.exists():
-        tree = denamespace(eadfile)
-        metadata['dateissued'] = tree.find("archdesc[@level='collection']/did/unittitle/unitdate").text.split('-', 1)[0]
+        # identifiers from mets
+        mets = metsfile if isinstance(metsfile, Mets) else Mets.load(metsfile)
+        metadata['identifiers'].extend(mets.dmd_identifiers('DMD1'))
+
+        if marcfile and marcfile.exists():
+            metadata['dateissued'] = marc_date_issued(marcfile, metadata['dateissued'])
+
+        elif eadfile and eadfile.exists():
+            metadata['dateissued'] = ead_date_issued(eadfile)
         
-    else:
-        raise FileNotFoundError("Neither marc file nor ead file exists")
+        else:
+            raise FileNotFoundError("Neither marc file nor ead file exists")
     
 
-    logging.debug(f"Metadata: {metadata}")
+        logging.debug(f"Metadata: {metadata}")
 
-    # generate the XML from the metadata collected.
-    mods = ET.Element('mods', attrib={'version': '3.5', 'xsi:schemaLocation': "http://www.loc.gov/mods/v3 http://www.loc.gov/standards/mods/v3/mods-3-5.xsd"})
-    # title        
-    ET.SubElement(ET.SubElement(mods, 'titleInfo'), 
-                 'title').text = metadata['title']
+        # generate the XML from the metadata collected.
+        mods = ET.Element('mods', attrib={'version': '3.5', 'xsi:schemaLocation': "http://www.loc.gov/mods/v3 http://www.loc.gov/standards/mods/v3/mods-3-5.xsd"})
+        # title        
+        ET.SubElement(ET.SubElement(mods, 'titleInfo'), 
+                     'title').text = metadata['title']
                        
-    # author
-    # UMICH didn't specify where to find this.
-    #ET.SubElement(ET.SubElement(mods, 'name', attrib={'type': "personal", 'usage': "Primary"}), 
-    #            'namePart').text = "The author name"
+        # author
+        # UMICH didn't specify where to find this.
+        #ET.SubElement(ET.SubElement(mods, 'name', attrib={'type': "personal", 'usage': "Primary"}), 
+        #            'namePart').text = "The author name"
     
-    # date issued
-    ET.SubElement(ET.SubElement(mods, 'originInfo'), 
-                'dateIssued', attrib={'encoding': 'marc'}).text = metadata['dateissued']
-
-    # format template (typeOfResource and physicalDescription)
-    ET.SubElement(mods, 'typeOfResource').text = 'moving image' if has_video else 'sound recording'
-    pd = ET.SubElement(mods, 'physicalDescription')
-    ET.SubElement(pd, 'form', attrib={'authority': 'gmd'}).text =  'video recording' if has_video else 'sound recording'
+        # date issued
+        ET.SubElement(ET.SubElement(mods, 'originInfo'), 
+                    'dateIssued', attrib={'encoding': 'marc'}).text = metadata['dateissued']
+
+        # format template (typeOfResource and physicalDescription)
+        ET.SubElement(mods, 'typeOfResource').text = 'moving image' if has_video else 'sound recording'
+        pd = ET.SubElement(mods, 'physicalDescription')
+        ET.SubElement(pd, 'form', attrib={'authority': 'gmd'}).text =  'video recording' if has_video else 'sound recording'
         
-    # unit note.
-    ET.SubElement(mods, 'note', attrib={'type': 'general'}).text = "Collection Name: UMICH"
-
-    # identifiers...can repeat for different things...
-    relItem = ET.SubElement(mods, 'relatedItem', attrib={'type': 'original'})
-    ET.SubElement(relItem, 'identifier', attrib={'type': 'local', 'displayLabel': 'UMICH Barcode'}).text = barcode
-    for d, n in metadata['identifiers']:
-        ET.SubElement(relItem, 'identifier', attrib={'type': 'local', 'displayLabel': d}).text = n
-
-    # record info template
-    # No info from UMICH to generate this.
-    #ri = ET.SubElement(mods, 'recordInfo')
-    #ET.SubElement(ri, 'recordCreationDate', attrib={'encoding': 'iso8601'}).text = 'creation date'
-    #ET.SubElement(ri, 'recordChangeDate', attrib={'encoding': 'iso8601'}).text = 'update date'
-    #ET.SubElement(ri, 'recordIdentifier', attrib={'source': 'UMICH'}).text = barcode
+        # unit note.
+        ET.SubElement(mods, 'note', attrib={'type': 'general'}).text = "Collection Name: UMICH"
+
+        # identifiers...can repeat for different things...
+        relItem = ET.SubElement(mods, 'relatedItem', attrib={'type': 'original'})
+        ET.SubElement(relItem, 'identifier', attrib={'type': 'local', 'displayLabel': 'UMICH Barcode'}).text = barcode
+        for d, n in metadata['identifiers']:
+            ET.SubElement(relItem, 'identifier', attrib={'type': 'local', 'displayLabel': d}).text = n
+
+        # record info template
+        # No info from UMICH to generate this.
+        #ri = ET.SubElement(mods, 'recordInfo')
+        #ET.SubElement(ri, 'recordCreationDate', attrib={'encoding': 'iso8601'}).text = 'creation date'
+        #ET.SubElement(ri, 'recordChangeDate', attrib={'encoding': 'iso8601'}).text = 'update date'
+        #ET.SubElement(ri, 'recordIdentifier', attrib={'source': 'UMICH'}).text = barcode
     
-    prettify(mods)
-    logging.debug(ET.tostring(mods).decode())
-    return ET.tostring(mods).decode()
+        prettify(mods)
+        result = ET.tostring(mods).decode()
+        logging.debug(result)
+        return result
+
+    def generate(self, items):
+        """Generate MODS for a batch of packages.  The items are dicts with the
+           arguments for avalon_mods.  Returns a list with the MODS (or the 
+           exception raised) for each item, in the same order"""
+        results = []
+        for item in items:
+            try:
+                results.append(self.avalon_mods(**item))
+            except Exception as e:
+                logger.error(f"Cannot generate MODS for {item.get('barcode')}: {e}")
+                results.append(e)
+        return results
+
+
+def avalon_mods(barcode, metadir, metsfile, marcfile: Path, eadfile: Path, has_video=False):
+    "Generate an avalon-compatible MODS file.  The metsfile can be a path or a parsed Mets"
+    return ModsEngine(metadir).avalon_mods(barcode, metsfile, marcfile, eadfile, has_video)
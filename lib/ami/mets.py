@@ -0,0 +1,65 @@
+"""
+METS document model.
+
+The METS file for a package is used by several processing steps, so it
+is parsed once and the parsed document is cached (per file) for everyone.
+"""
+from pathlib import Path
+from collections import OrderedDict
+import threading
+import xml.etree.ElementTree as ET
+
+# how many parsed documents to keep around
+CACHE_SIZE = 32
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class Mets:
+    "A parsed METS file"
+    def __init__(self, metsfile: Path):
+        self.path = Path(metsfile)
+        self.tree = ET.parse(self.path)
+        self.root = self.tree.getroot()
+
+    @staticmethod
+    def load(metsfile: Path):
+        "Get the parsed METS file, reusing a cached copy if the file hasn't changed"
+        path = Path(metsfile).resolve()
+        s = path.stat()
+        signature = (s.st_mtime_ns, s.st_size)
+        with _cache_lock:
+            if path in _cache and _cache[path][0] == signature:
+                _cache.move_to_end(path)
+                return _cache[path][1]
+        mets = Mets(path)
+        with _cache_lock:
+            _cache[path] = (signature, mets)
+            _cache.move_to_end(path)
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+        return mets
+
+    def production_masters(self):
+        "Get the production_master media files (and mime types).  The dict returned is a fresh copy"
+        files = {}
+        for file in self.root.findall('.//{*}fileGrp/{*}fileGrp[@USE="production_master"]/{*}file'):
+            files[file.attrib['ID']] = {'type': file.attrib['MIMETYPE']}
+        return files
+
+    @property
+    def struct_map(self):
+        "The structMap element"
+        return self.root.find(".//{*}structMap")
+
+    def dmd_identifiers(self, dmdid='DMD1'):
+        "Get the [MDTYPE, href] pairs for the mdRefs in a dmdSec"
+        identifiers = []
+        for mdref in self.root.findall(f"{{*}}dmdSec[@ID='{dmdid}']/{{*}}mdRef"):
+            href = None
+            for k, v in mdref.attrib.items():
+                if k == 'href' or k.endswith('}href'):
+                    href = v
+            identifiers.append([mdref.attrib.get('MDTYPE', 'Unknown'), href])
+        return identifiers
@@ -1,9 +1,71 @@
-from datetime import datetime
-from pymongo.database import Database
+from datetime import datetime, timezone
+import atexit
+import copy
+import hashlib
 import logging
+import os
+import socket
+import threading
 import time
 import traceback
-from ami import Ami
+import uuid
+import weakref
+from ami import Ami, ASCENDING
+
+# packages with buffered changes that haven't been written to the database
+_unflushed = weakref.WeakSet()
+_unflushed_lock = threading.Lock()
+
+
+def flush_all():
+    "Write the buffered changes for every package"
+    with _unflushed_lock:
+        packages = list(_unflushed)
+    for p in packages:
+        p.flush()
+
+
+def _forget_unflushed():
+    """In a forked child, drop the buffered changes inherited from the
+       parent: they are the parent's to write.  Anything that has to be seen
+       by the child should be flushed before forking"""
+    global _unflushed_lock
+    _unflushed_lock = threading.Lock()
+    for p in list(_unflushed):
+        p.lock = threading.RLock()
+        p.flush_timer = None
+        p.pending_paths = set()
+        p.pending_logs = []
+    _unflushed.clear()
+
+
+# don't lose anything at exit, and don't let a forked child inherit (and
+# later write a second copy of) the parent's buffered changes
+atexit.register(flush_all)
+os.register_at_fork(after_in_child=_forget_unflushed)
+
+
+class PackageDocument(dict):
+    """A package document that was loaded with a projection.  Fields that
+       weren't loaded are fetched from the database the first time they
+       are used"""
+    def __init__(self, data, collection):
+        super().__init__(data)
+        self.collection = collection
+
+    def __missing__(self, key):
+        doc = self.collection.find_one({'_id': dict.__getitem__(self, '_id')}, {key: 1})
+        if doc is None or key not in doc:
+            raise KeyError(key)
+        self[key] = doc[key]
+        return doc[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
 
 class Package:
     states = {
@@ -33,6 +95,11 @@ class Package:
         'deleted': False,
     }
 
+    # states a worker is in while it is working on the package.  A lease is
+    # kept when moving between these, and given up on any other state.
+    working_states = {'validating', 'shaping', 'processing', 'storing',
+                      'distributing', 'submitting', 'cleaning'}
+
     @staticmethod
     def create(ami, pkgid, state="transferred"):
         "Create the a new package in the database"
@@ -40,29 +107,59 @@ class Package:
             raise ValueError("Invalid state")
         
         data = {
-            '_version': 2,
+            '_version': 3,
             'id': pkgid,
             'timestamp': datetime.now().strftime("%Y%m%d-%H%M%S"),
             'state': state,
             'state_change': time.time(),
-            'log': [],
+            'latest': True,
             'app_data': {},
             'sda_location': None,
             'avalon_location': None,
         }
 
-        res = ami.get_db().packages.insert_one(data)        
+        db = ami.get_db()
+        res = db.packages.insert_one(data)        
         _id = res.inserted_id
-        p = Package(ami, _id)
+        # only one version of a package is the latest one: this one, unless
+        # a newer version showed up in the meantime.  Older versions which
+        # haven't been marked yet are marked here too, so mark_latest can't
+        # later decide one of them is the latest.
+        db.packages.update_many({'id': pkgid, 'latest': {'$ne': False}, 'timestamp': {'$lt': data['timestamp']}},
+                                {'$set': {'latest': False}})
+        if db.packages.find_one({'id': pkgid, 'timestamp': {'$gt': data['timestamp']}}, {'_id': 1}):
+            db.packages.update_one({'_id': _id}, {'$set': {'latest': False}})
+            data['latest'] = False
+        p = Package(ami, _id, data)
         p.log("info", "Package initialized")
         return p
 
 
-    def __init__(self, ami:Ami, _id):
-        "Reconstitute a package in mongodb into a python object"
+    def __init__(self, ami:Ami, _id, data=None, partial=False):
+        """Reconstitute a package in mongodb into a python object.  If the
+           document has already been fetched it can be passed in as data, and
+           if it was fetched with a projection, partial should be set so the
+           other fields are loaded when needed"""
         self.ami = ami
         self.db = ami.get_db()
-        self.data = self.db.packages.find_one({'_id': _id})        
+
+        # Log entries and field changes are buffered and written together.
+        # The changed fields are recorded as dotted paths and their values
+        # are taken from self.data when the buffer is flushed.
+        self.lock = threading.RLock()
+        self.pending_paths = set()
+        self.pending_logs = []
+        self.flush_timer = None
+        self.flush_interval = ami.config['mongodb'].get('write_behind', 0)
+        # the lease we hold on the package, if it was claimed
+        self.lease_owner = None
+        self.lease_stop = None
+        self.lease_lost = False
+        if data is None:
+            data = self.db.packages.find_one({'_id': _id})
+        elif partial:
+            data = PackageDocument(data, self.db.packages)
+        self.data = data
         if self.data is None:
             raise KeyError("No package with that id")
         
@@ -76,13 +173,104 @@ class Package:
                                         {'$set': {'avalon_location': None,
                                                   '_version': 2}})           
             self.__init__(ami, self.data['_id'])
-            
+            return
+
+        if self.data['_version'] < 3:
+            # the log moved from the document to the package_logs collection.
+            # The entries are copied before the version is flipped, with ids
+            # derived from their position, so a copy that was interrupted (or
+            # done by someone else at the same time) can simply be repeated.
+            from bson import ObjectId
+            entries = []
+            for i, x in enumerate(self.data.get('log') or []):
+                entry = self._log_entry(x, datetime.strptime(x['time'], "%Y%m%d-%H%M%S").astimezone(timezone.utc))
+                entry['_id'] = ObjectId(hashlib.md5(f"{self.data['_id']}/{i}".encode()).digest()[:12])
+                entries.append(entry)
+            self._insert_logs(entries)
+            self.db.packages.update_one({'_id': self.data['_id'], '_version': {'$lt': 3}},
+                                        {'$set': {'_version': 3}, '$unset': {'log': ""}})
+            self.__init__(ami, self.data['_id'])
+            return
+
         
     def __str__(self):
         return str(self.data)
 
     __repr__ = __str__
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+
+    def _changed(self, path=None, log=None, write=True):
+        """Buffer a changed field path and/or a log entry.  Without write
+           behind they're written immediately, unless write is False because
+           the caller has more to go with them"""
+        with self.lock:
+            if path is not None:
+                if not any(path == p or path.startswith(p + ".") for p in self.pending_paths):
+                    # drop anything this path contains, since it will be written as part of it
+                    self.pending_paths = {p for p in self.pending_paths if not p.startswith(path + ".")}
+                    self.pending_paths.add(path)
+            if log is not None:
+                self.pending_logs.append(log)
+            if not self.flush_interval and write:
+                self.flush()
+                return
+            with _unflushed_lock:
+                _unflushed.add(self)
+            if self.flush_interval and self.flush_timer is None:
+                self._start_timer()
+
+    def _start_timer(self):
+        self.flush_timer = threading.Timer(self.flush_interval, self._timed_flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def _timed_flush(self):
+        "Flush from the timer.  If it fails, the timer is started again by flush"
+        try:
+            self.flush()
+        except Exception as e:
+            logging.warning(f"{self.get_id()}/{self.get_timestamp()}: couldn't write the buffered changes, will retry: {e}")
+
+    def _value(self, path):
+        "Get the current value of a dotted path in the local data"
+        value = self.data
+        for k in path.split("."):
+            value = value[k]
+        return copy.deepcopy(value)
+
+    def flush(self):
+        """Write all of the buffered changes with a single update.  If it
+           fails, the changes stay buffered for the next flush"""
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if not self.pending_paths and not self.pending_logs:
+                return
+            update = {}
+            if self.pending_paths:
+                update['$set'] = {p: self._value(p) for p in self.pending_paths}
+            try:
+                if update:
+                    self.db.packages.update_one({'_id': self.data['_id']}, update)
+                if self.pending_logs:
+                    self._insert_logs(self.pending_logs)
+            except Exception:
+                # keep everything for the next try
+                if self.flush_interval:
+                    self._start_timer()
+                raise
+            self.pending_paths = set()
+            self.pending_logs = []
+            with _unflushed_lock:
+                _unflushed.discard(self)
+
 
     def get_id(self):
         "Return the package id"
@@ -95,12 +283,120 @@ class Package:
         if external and not Package.states[state]:
             raise ValueError("Cannot change to this state externally")
                 
-        oldstate = self.data['state']
-        if oldstate != state:
+        # state changes are written immediately, along with anything
+        # else that has been buffered.  If the package was claimed, the
+        # change only happens if we still hold the lease.  The lease is kept
+        # while the package moves between working states and given up when
+        # it is handed off to another state.
+        with self.lock:
+            if self.lease_lost:
+                self.log('warn', f"The lease on this package was lost, not changing the state to {state}")
+                return
+            if self.lease_owner is not None:
+                owner = self.lease_owner
+                keep = state in Package.working_states
+                self.flush()
+                now = time.time()
+                update = {'state': state, 'state_change': now}
+                if not keep:
+                    update['lease'] = None
+                res = self.db.packages.update_one({'_id': self.data['_id'], 'lease.owner': owner,
+                                                   'state': self.data['state']},
+                                                  {'$set': update})
+                if res.matched_count == 0:
+                    self._stop_heartbeat()
+                    self.lease_lost = True
+                    self.log('warn', f"The lease {owner} on this package was lost, not changing the state to {state}")
+                    return
+                if not keep:
+                    self._stop_heartbeat()
+                oldstate = self.data['state']
+                self.data.update(update)
+                self.log('info', f"State changed from {oldstate} to {state}")
+                self.flush()
+                return
+
+            oldstate = self.data['state']
+            if oldstate != state:
+                self.data['state'] = state
+                self.data['state_change'] = time.time()
+                # the state, the time and the log entry go in one write.
+                # Whoever held a lease on the package loses it, so a worker
+                # can't overwrite this change with its own.
+                self.data['lease'] = None
+                self._changed('state', write=False)
+                self._changed('state_change', write=False)
+                self._changed('lease', write=False)
+                self.log('info', f"State changed from {oldstate} to {self.data['state']}")
+                self.flush()
+
+    def claim(self, expected, state):
+        """Atomically move the package from the expected state to a new
+           state, taking a lease on it.  The lease is kept alive by a
+           heartbeat until the state is changed again, and if the holder
+           goes away the lease expires and the package can be reclaimed.
+           Returns False if the package wasn't in the expected state"""
+        if state not in Package.states:
+            raise ValueError("Invalid state")
+        lease_time = self.ami.config['mongodb'].get('lease_time', 300)
+        with self.lock:
+            self.flush()
+            owner = f"{socket.gethostname()}/{os.getpid()}/{uuid.uuid4().hex[:8]}"
+            now = time.time()
+            lease = {'owner': owner, 'expires': now + lease_time}
+            res = self.db.packages.find_one_and_update({'_id': self.data['_id'], 'state': expected},
+                                                       {'$set': {'state': state, 'state_change': now,
+                                                                 'lease': lease}},
+                                                       {'_id': 1})
+            if res is None:
+                logging.debug(f"{self.get_id()}/{self.get_timestamp()} is no longer {expected}, not claiming it")
+                return False
             self.data['state'] = state
-            self.db.packages.update_one({'_id': self.data['_id']}, 
-                                        {'$set': {'state': state, 'state_change': time.time()}})
-            self.log('info', f"State changed from {oldstate} to {self.data['state']}")
+            self.data['state_change'] = now
+            self.data['lease'] = lease
+            self.lease_owner = owner
+            self.lease_lost = False
+            self.lease_stop = threading.Event()
+            t = threading.Thread(target=self._heartbeat, args=(owner, self.lease_stop, lease_time), daemon=True)
+            t.start()
+            self.log('info', f"State changed from {expected} to {state} by {owner}")
+            self.flush()
+            return True
+
+    def _heartbeat(self, owner, stop, lease_time):
+        "Renew the lease until told to stop"
+        while not stop.wait(lease_time / 3):
+            res = self.db.packages.update_one({'_id': self.data['_id'], 'lease.owner': owner},
+                                              {'$set': {'lease.expires': time.time() + lease_time}})
+            if res.matched_count == 0 and not stop.is_set():
+                logging.warning(f"{self.get_id()}/{self.get_timestamp()}: lease {owner} was lost")
+                with self.lock:
+                    if self.lease_owner == owner:
+                        self.lease_lost = True
+                return
+
+    def _stop_heartbeat(self):
+        if self.lease_stop is not None:
+            self.lease_stop.set()
+        self.lease_owner = None
+        self.lease_stop = None
+        self.lease_lost = False
+
+    @staticmethod
+    def reclaim(ami, state, fallback):
+        """Put packages whose lease in state has expired back into the fallback
+           state, so they can be claimed again.  Returns the number reclaimed"""
+        db = ami.get_db()
+        count = 0
+        for doc in db.packages.find({'latest': True, 'state': state, 'lease.expires': {'$lt': time.time()}}, {'_id': 1, 'lease': 1}):
+            res = db.packages.update_one({'_id': doc['_id'], 'state': state, 'lease.owner': doc['lease']['owner']},
+                                         {'$set': {'state': fallback, 'state_change': time.time(), 'lease': None}})
+            if res.modified_count:
+                p = Package(ami, doc['_id'])
+                p.log('warn', f"Lease {doc['lease']['owner']} expired while {state}, state changed to {fallback}")
+                p.flush()
+                count += 1
+        return count
 
     def get_state(self):
         "Get the package state"
@@ -111,9 +407,43 @@ class Package:
         return self.data['state_change']
 
 
-    def get_logs(self):
-        "Return the logs for the package"
-        return self.data['log']
+    def _log_entry(self, msg, created):
+        "Make a package_logs document from a log message"
+        return {'package': self.data['_id'], 'created': created, **msg}
+
+    def _insert_logs(self, entries):
+        """Write log entries.  The entries keep the ids they were given the
+           first time, so writing them again after a failure skips the ones
+           which made it the first time"""
+        if not entries:
+            return
+        from bson import ObjectId
+        from pymongo.errors import BulkWriteError
+        for e in entries:
+            e.setdefault('_id', ObjectId())
+        try:
+            self.db.package_logs.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            if e.details.get('writeConcernErrors') or any(x['code'] != 11000 for x in e.details['writeErrors']):
+                raise
+
+    def get_logs(self, batch=500):
+        "Iterate over the logs for the package, oldest first, fetching them a batch at a time"
+        self.flush()
+        query = {'package': self.data['_id']}
+        last = None
+        while True:
+            if last is not None:
+                query['$or'] = [{'created': {'$gt': last['created']}},
+                                {'created': last['created'], '_id': {'$gt': last['_id']}}]
+            entries = list(self.db.package_logs.find(query)
+                           .sort([('created', ASCENDING), ('_id', ASCENDING)])
+                           .limit(batch))
+            for e in entries:
+                yield {'time': e['time'], 'severity': e['severity'], 'message': e['message']}
+            if len(entries) < batch:
+                break
+            last = entries[-1]
 
     def log(self, severity, message, exception=False):
         "Add to the package log"
@@ -127,18 +457,21 @@ class Package:
         msg = {'time': datetime.now().strftime("%Y%m%d-%H%M%S"),
                'severity': severity,
                'message': message}               
-        self.db.packages.update_one({'_id': self.data['_id']},
-                                    {'$push': {'log': msg}})
-        self.data['log'].append(msg)
+        with self.lock:
+            self._changed(log=self._log_entry(msg, datetime.now(timezone.utc)))
+            if severity.lower() == 'error':
+                self.flush()
         
 
     def reset(self):
         "Reset the object to accepted and clear out data"
+        self.flush()
         self.db.packages.update_one({'_id': self.data['_id']},
                                     {'$set': {'state': 'accepted', 
                                               'state_changed': time.time(), 
-                                              'log': [],
-                                              'app_data': {}}})
+                                              'app_data': {},
+                                              'lease': None}})
+        self.db.package_logs.delete_many({'package': self.data['_id']})
         self.log('info', "Object has been reset to its initial state")
 
     def get_timestamp(self):
@@ -159,16 +492,13 @@ class Package:
         "Set the stored application-specific data for this object"
         if appname is None:
             appname = self.ami.get_application()
-        if appname not in self.data['app_data']:            
-            self.data['app_data'][appname] = {}
-            self.db.packages.update_one({'_id': self.data['_id']},
-                                        {'$set': {'app_data.' + appname: {}}})
-        
-
-        self.data['app_data'][appname][key] = data
+        with self.lock:
+            if appname not in self.data['app_data']:            
+                self.data['app_data'][appname] = {}
+                self._changed('app_data.' + appname)
 
-        self.db.packages.update_one({'_id': self.data['_id']},
-                                    {'$set': {'app_data.' + appname + "." + key: data}})
+            self.data['app_data'][appname][key] = data
+            self._changed('app_data.' + appname + "." + key)
 
                                     
     def get_sda_location(self):
@@ -177,9 +507,9 @@ class Package:
 
     def set_sda_location(self, location):
         "Set the root path for the object on SDA"
-        self.data['sda_location'] = location
-        self.db.packages.update_one({'_id': self.data['_id']},
-                                    {'$set': {'sda_location': location}})
+        with self.lock:
+            self.data['sda_location'] = location
+            self._changed('sda_location')
 
 
     def get_avalon_location(self):
@@ -188,6 +518,6 @@ class Package:
 
     def set_avalon_location(self, location):
         "Set the URL for the avalon access URL"
-        self.data['avalon_location'] = location
-        self.db.packages.update_one({'_id': self.data['_id']},
-                                    {'$set': {'avalon_location': location}})
+        with self.lock:
+            self.data['avalon_location'] = location
+            self._changed('avalon_location')
@@ -1,10 +1,18 @@
 import fnmatch
-from pymongo import ASCENDING, DESCENDING
+from . import ASCENDING, DESCENDING
 from .package import Package
 import logging
 
 logger = logging.getLogger()
 
+# projection for callers that list packages but don't show the logs (only
+# documents from before the package_logs collection still carry them)
+NO_LOGS = {'log': 0}
+
+# fields the queries below need, whatever the projection
+REQUIRED_FIELDS = ('_id', '_version', 'id', 'timestamp', 'state')
+
+
 class PackageFactory:
     def __init__(self, ami):
         self.ami = ami
@@ -26,61 +34,77 @@ class PackageFactory:
         res = self.db.packages.find({'id': pkgid}, {'timestamp': 1})
         return res.distinct("timestamp")
 
-    def get_package(self, pkgid, timestamp=None):
-        " Fetch a package object with the latest timestamp, unless specified"
+    @staticmethod
+    def _projection(projection):
+        "Make sure a projection includes the fields that are always needed"
+        if projection is None:
+            return None
+        projection = dict(projection)
+        if any(projection.values()):
+            # inclusion projection
+            for f in REQUIRED_FIELDS:
+                projection[f] = 1
+        else:
+            for f in REQUIRED_FIELDS:
+                projection.pop(f, None)
+        return projection
+
+    def _packages(self, docs, projection=None):
+        "Build packages from the documents returned by a query"
+        return [Package(self.ami, x['_id'], x, partial=projection is not None) for x in docs]
+
+    def get_package(self, pkgid, timestamp=None, projection=None):
+        """Fetch a package object with the latest timestamp, unless specified.
+           If a projection is given, only those fields are loaded up front"""
         query = {'id': pkgid}
         if timestamp:
             query['timestamp'] = timestamp
         else:
-            pass
-        res = self.db.packages.find(query, {'_id': 1}).sort('timestamp', DESCENDING).limit(1)
-        if res:            
-            return Package(self.ami, res[0]['_id'])
+            query['latest'] = True
+        projection = self._projection(projection)
+        res = self.db.packages.find(query, projection).sort('timestamp', DESCENDING).limit(1)
+        doc = next(res, None)
+        if doc is not None:
+            return self._packages([doc], projection)[0]
         else:
             raise KeyError("No package with those specs")
 
-    def packages_by_state(self, state, all=False):
-        "Grab all of the (latest) packages with a given state"
+    def packages_by_state(self, state, all=False, projection=None):
+        """Grab all of the (latest) packages with a given state.  If a projection
+           is given, only those fields are loaded up front"""
         if state not in Package.states:
             raise ValueError("Invalid state")
 
+        projection = self._projection(projection)
+        # The newest version of each package has the latest flag set, and
+        # the (latest, state, state_change) index covers both queries.
         if not all:
-            # This is moderately complex:
-            # * sort by reverse timestamp (to put the latest version of packages earlier)
-            # * group by package id, collecting the original _id and the state from the first (only!)
-            # * push the minidocument to the root
-            # * filter for the state we're looking for
-            res = self.db.packages.aggregate([
-                {'$sort': {'timestamp': -1}},
-                {'$group': {
-                    '_id': '$id',
-                    'doc': {'$first': {'_id': '$_id', 'state': '$state'}},
-                }},
-                {'$replaceRoot': {'newRoot': '$doc'}},
-                {'$match': {'state': state}}
-            ])
+            query = {'latest': True, 'state': state}
         else:
-            res = self.db.packages.find({'state': state})
-        return [Package(self.ami, x['_id']) for x in res]
+            query = {'latest': {'$in': [True, False]}, 'state': state}
+        res = self.db.packages.find(query, projection).sort('state_change', ASCENDING)
+        return self._packages(res, projection)
 
 
-    def find_packages(self, *packagespec):
+    def find_packages(self, *packagespec, projection=None):
         """Find packages matching a package specs:
         * If the spec starts with '.' it is a state search, for the latest timestamp
         * If the spec starts with '+' is is a state search for all timestamps
         * Otherwise, it's a package specification and it follows these rules:
         ** If it contains '/' it is a package_id/timestamp pair.  Both the package_id and timestamp can contain wildcards
         ** if it doesn't contain '/', then it's a package_id (with possible wildcards)
+        If a projection is given, only those fields are loaded up front.
         """
+        projection = self._projection(projection)
         results = set()
         for spec in packagespec:
             try:
                 if spec.startswith('.'):
                     # latest with states
-                    results.update(self.packages_by_state(spec[1:]))
+                    results.update(self.packages_by_state(spec[1:], projection=projection))
                 elif spec.startswith('+'):
                     # all with state
-                    results.update(self.packages_by_state(spec[1:], all=True))
+                    results.update(self.packages_by_state(spec[1:], all=True, projection=projection))
                 else:
                     # object spec
                     if '/' in spec:
@@ -88,21 +112,13 @@ class PackageFactory:
                         pregex = "^" + fnmatch.translate(pkg_id) + "$"
                         tregex = "^" + fnmatch.translate(timestamp) + "$"
                         res = self.db.packages.find({'id': {'$regex': pregex},
-                                                     'timestamp': {'$regex': tregex}})
-                        results.update([Package(self.ami, x['_id']) for x in res])
+                                                     'timestamp': {'$regex': tregex}}, projection)
+                        results.update(self._packages(res, projection))
                     else:
-                        # plain object (use the same method as in packages_by_state)
+                        # plain object (the latest version of each matching id)
                         regex = "^" + fnmatch.translate(spec) + "$"
-                        res = self.db.packages.aggregate([
-                            {'$match': {'id': {'$regex': regex}}},  # find the ids that match
-                            {'$sort': {'timestamp': -1}},  # sort so the newest is first
-                            {'$group': {
-                                '_id': '$id',
-                                'doc': {'$first': {'_id': '$_id'}},
-                            }}, # group so only the first package id is kept
-                            {'$replaceRoot': {'newRoot': '$doc'}} # return only the _id fields                            
-                        ])
-                        results.update([Package(self.ami, x['_id']) for x in res])
+                        res = self.db.packages.find({'id': {'$regex': regex}, 'latest': True}, projection)
+                        results.update(self._packages(res, projection))
 
             except Exception as e:
                 logger.debug(f"Could not find package for {spec}: {e}")
@@ -1,42 +1,92 @@
 """
 Switchyard REST API wrapper
 """
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import random
+import threading
 import time
 import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger()
 
 class Switchyard:
-    def __init__(self, url, token, retries=3, retry_time=3):
+    """
+    A Switchyard client.  All of the requests go through one session, so
+    connections are kept alive and reused, and it is safe to share the
+    client between threads.  Requests which failed with a 5xx or 429 are
+    retried with exponential backoff (retry_time, doubling up to
+    max_retry_time, with jitter).  Timeouts and connection errors are only
+    retried for GETs: a POST may have been done even though the response
+    never arrived.
+    """
+    def __init__(self, url, token, retries=3, retry_time=3, max_retry_time=60,
+                 max_connections=8, timeout=60):
         self.url = url
         self.token = token
         self.retries = retries
         self.retry_time = retry_time
+        self.max_retry_time = max_retry_time
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['api-token'] = token
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # latency (in seconds) of each request, by method
+        self.latencies = {}
+        self.stats_lock = threading.Lock()
 
-    def _make_request(self, method, url, data=None):        
+    def _backoff(self, attempt):
+        "How long to wait before the given retry (0 is the first)"
+        delay = min(self.max_retry_time, self.retry_time * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _make_request(self, method, url, data=None):
         "Make a request and handle the data"
-        retries = self.retries
+        attempt = 0
         while True:
+            start = time.time()
             try:
-                if method == "GET":
-                    r = requests.get(self.url + url, headers={'api-token': self.token})            
-                elif method == "POST":
-                    r = requests.post(self.url + url, headers={'api-token': self.token}, json=data)
-                else:
+                if method not in ("GET", "POST"):
                     raise ValueError(f"Unhandled method {method}")
+                r = self.session.request(method, self.url + url, json=data, timeout=self.timeout)
+                self._record(method, time.time() - start)
                 r.raise_for_status()
                 return r.json()
 
             except requests.HTTPError as e:
-                if retries < 0 or e.response.status_code == 401:
-                    print(e.request.url, e.request.headers)
+                code = e.response.status_code
+                if attempt >= self.retries or not (code == 429 or code >= 500):
+                    logger.debug(f"Giving up on {method} {e.request.url}")
                     raise IOError(e)
                 logger.debug(f"Failed retrieving {method} {url}: {e}")
-                retries -= 1
-                time.sleep(self.retry_time)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(method, time.time() - start)
+                if attempt >= self.retries or method != "GET":
+                    raise IOError(e)
+                logger.debug(f"Failed connecting for {method} {url}: {e}")
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    def _record(self, method, seconds):
+        with self.stats_lock:
+            self.latencies.setdefault(method, []).append(seconds)
 
-        
+    def latency_summary(self):
+        "Get the count, mean, median, 95th percentile and max latency (in seconds) of the requests by method"
+        summary = {}
+        with self.stats_lock:
+            for method, times in self.latencies.items():
+                times = sorted(times)
+                summary[method] = {'count': len(times),
+                                   'mean': sum(times) / len(times),
+                                   'p50': times[len(times) // 2],
+                                   'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+                                   'max': times[-1]}
+        return summary
 
     def get_processing_status(self, group):
         "get the processing status of a group"
@@ -45,11 +95,22 @@ class Switchyard:
             raise Exception(res['message'])
         return res
 
+    def get_processing_statuses(self, groups, workers=None):
+        """Get the processing status of several groups, with up to workers
+           (default: max_connections) requests at a time.  Returns a dict of
+           group -> either the status or the exception"""
+        results = {}
+        with ThreadPoolExecutor(max_workers=workers or self.max_connections) as tpe:
+            futures = {group: tpe.submit(self.get_processing_status, group) for group in groups}
+            for group, f in futures.items():
+                try:
+                    results[group] = f.result()
+                except Exception as e:
+                    results[group] = e
+        return results
+
     def submit_group(self, group, data):
         "Sumbit a group file for processing"
         res = self._make_request("POST", "/media_objects/create", data)
         if res['error']:
             raise Exception(res['message'])
-
-
-    
\ No newline at end of file
@@ -0,0 +1,358 @@
+"""
+Transcoding support: source probing, ffmpeg supervision and a process-wide
+scheduler which shares the host's cores between the ffmpeg jobs of every
+package.
+"""
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+import heapq
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger()
+
+
+def probe_source(ffprobe, file: Path):
+    """Get the duration (in seconds) and the largest frame size of a source
+       file, and the indexes of the video and audio streams ffmpeg picks when
+       it chooses the streams itself.  Anything that can't be determined is
+       zero (or None for the streams)"""
+    info = {'duration': 0.0, 'width': 0, 'height': 0, 'video_stream': None, 'audio_stream': None}
+    p = subprocess.run([ffprobe,
+                        '-print_format', 'json',
+                        '-show_format', '-show_streams',
+                        '-loglevel', '0',
+                        str(file)],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                       encoding='utf-8')
+    if p.returncode != 0:
+        logger.debug(f"Cannot probe {file!s}: ffprobe returned {p.returncode}")
+        return info
+    data = json.loads(p.stdout or '{}')
+    try:
+        info['duration'] = float(data.get('format', {}).get('duration', 0))
+    except ValueError:
+        pass
+    for stream in data.get('streams', []):
+        if stream.get('codec_type') == 'video' and stream.get('width', 0) * stream.get('height', 0) > info['width'] * info['height']:
+            info['width'] = stream['width']
+            info['height'] = stream['height']
+    info['video_stream'], info['audio_stream'] = default_streams(data.get('streams', []))
+    return info
+
+
+def default_streams(streams):
+    """Pick the video and audio streams (from ffprobe's list) the way ffmpeg
+       does when an output has no -map: the video with the most pixels and
+       the audio with the most channels, preferring default streams and
+       then the first one.  Returns their indexes, or None"""
+    best = {'video': (None, -1), 'audio': (None, -1)}
+    for stream in streams:
+        kind = stream.get('codec_type')
+        disposition = stream.get('disposition', {})
+        if kind == 'video' and not disposition.get('attached_pic'):
+            score = stream.get('width', 0) * stream.get('height', 0)
+        elif kind == 'audio':
+            score = stream.get('channels', 0)
+        else:
+            continue
+        score += 5000000 * bool(disposition.get('default'))
+        if score > best[kind][1]:
+            best[kind] = (stream['index'], score)
+    return best['video'][0], best['audio'][0]
+
+
+def estimate_cost(probe, file: Path = None):
+    """Estimate the relative cost of transcoding a source.  This is only used
+       to order the jobs, so it is roughly seconds times megapixels, with
+       audio being much cheaper than any video"""
+    if not probe['duration']:
+        # no idea, so guess from the size of the file
+        return file.stat().st_size / 1e6 if file is not None and file.exists() else 0
+    return probe['duration'] * (0.01 + probe['width'] * probe['height'] / 1e6)
+
+
+def strip_threads(args):
+    "Remove any -threads options from an ffmpeg argument list"
+    result = []
+    skip = False
+    for a in args:
+        if skip:
+            skip = False
+        elif a == '-threads':
+            skip = True
+        else:
+            result.append(a)
+    return result
+
+
+def split_filter_chain(chain):
+    """Split an ffmpeg filter chain into its filters.  Commas which are
+       escaped with a backslash or inside single quotes are part of a
+       filter's arguments, and are kept as they were written"""
+    filters = []
+    current = []
+    quoted = False
+    escaped = False
+    for c in chain:
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == "'":
+            quoted = not quoted
+        elif c == ',' and not quoted:
+            filters.append("".join(current))
+            current = []
+            continue
+        current.append(c)
+    filters.append("".join(current))
+    return [f for f in filters if f]
+
+
+def split_video_filters(args):
+    """Pull the video filter chain out of an ffmpeg argument list.  Returns
+       the list of filters and the remaining arguments"""
+    filters = []
+    rest = []
+    it = iter(args)
+    for a in it:
+        if a in ('-vf', '-filter:v'):
+            filters.extend(split_filter_chain(next(it)))
+        else:
+            rest.append(a)
+    return filters, rest
+
+
+def multi_rendition_args(source: Path, renditions, threads=0, video_stream=None, audio_stream=None):
+    """Build the ffmpeg arguments (after the binary) to produce several
+       renditions from a single decode of the source.  Renditions are a dict
+       of name -> (argument list, output file).
+
+       Video renditions share one filter graph: the filters common to all
+       of them (deinterlacing, usually) run once and the result is split
+       into the per-rendition chains.  The graph reads video_stream and the
+       renditions get audio_stream, which should be the streams ffmpeg
+       would pick by itself (see default_streams) so the renditions are the
+       same as ones made one at a time.  If they aren't known, the first
+       video and audio streams are used.  Audio-only (-vn) renditions, and
+       ones which choose their own streams with -map, are just additional
+       outputs, which ffmpeg feeds from the same decode."""
+    video = {}
+    audio = {}
+    for name, (args, outfile) in renditions.items():
+        args = strip_threads(args)
+        if '-vn' in args or '-map' in args:
+            audio[name] = (args, outfile)
+        else:
+            video[name] = split_video_filters(args) + (outfile,)
+
+    cmd = ['-y', '-threads', str(threads), '-nostdin', '-i', str(source)]
+    output_threads = str(max(1, threads // len(renditions)) if threads else 0)
+    if video:
+        chains = [x[0] for x in video.values()]
+        common = []
+        for filters in zip(*chains):
+            if any(f != filters[0] for f in filters):
+                break
+            common.append(filters[0])
+        source_video = "0:v:0" if video_stream is None else f"0:{video_stream}"
+        graph = [f"[{source_video}]{','.join(common) or 'null'},split={len(video)}" +
+                 "".join(f"[s{i}]" for i in range(len(video)))]
+        for i, filters in enumerate(chains):
+            graph.append(f"[s{i}]{','.join(filters[len(common):]) or 'null'}[v{i}]")
+        cmd.extend(['-filter_complex', ";".join(graph)])
+        if threads:
+            cmd.extend(['-filter_complex_threads', str(threads)])
+        source_audio = "0:a:0?" if audio_stream is None else f"0:{audio_stream}"
+        for i, (filters, args, outfile) in enumerate(video.values()):
+            maps = ['-map', f"[v{i}]"]
+            if '-an' not in args and (audio_stream is not None or video_stream is None):
+                maps.extend(['-map', source_audio])
+            cmd.extend([*maps, *args, '-threads', output_threads, str(outfile)])
+    for args, outfile in audio.values():
+        cmd.extend([*args, '-threads', output_threads, str(outfile)])
+    return cmd
+
+
+def parse_speed(speed):
+    "Convert ffmpeg's speed ('1.5x') to a float, or None if it isn't known"
+    try:
+        return float(speed.rstrip('x'))
+    except (AttributeError, ValueError):
+        return None
+
+
+def supervise_ffmpeg(cmd, logfile: Path, duration=0, stall_timeout=0, callback=None,
+                     interval=30, tail_lines=100):
+    """Run an ffmpeg command line (binary first) while watching its progress.
+
+       The full ffmpeg log goes to logfile, and only the last tail_lines are
+       kept in memory for error reports.  Every interval seconds the callback
+       is called with a dict of out_time (seconds), speed, fps and eta (seconds,
+       when the duration of the source is known).  If stall_timeout is set and
+       the output doesn't move for that long, ffmpeg is killed.
+
+       Returns (return code, stalled, tail of the log)"""
+    tail = deque(maxlen=tail_lines)
+    state = {'progress': {}, 'moved': time.monotonic(), 'position': None}
+    lock = threading.Lock()
+
+    proc = subprocess.Popen([cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, encoding='utf-8', errors='replace',
+                            start_new_session=True)
+
+    def read_log():
+        with open(logfile, "w") as log:
+            for line in proc.stderr:
+                log.write(line)
+                tail.append(line.rstrip())
+
+    def read_progress():
+        block = {}
+        for line in proc.stdout:
+            key, _, value = line.strip().partition('=')
+            block[key] = value
+            if key != 'progress':
+                continue
+            try:
+                out_time = int(block.get('out_time_us', 'N/A')) / 1e6
+            except ValueError:
+                out_time = 0.0
+            speed = parse_speed(block.get('speed'))
+            progress = {'out_time': out_time,
+                        'speed': speed,
+                        'fps': block.get('fps'),
+                        'eta': (duration - out_time) / speed if duration and speed else None}
+            position = (block.get('out_time_us'), block.get('total_size'))
+            with lock:
+                state['progress'] = progress
+                if position != state['position']:
+                    state['position'] = position
+                    state['moved'] = time.monotonic()
+            block = {}
+
+    readers = [threading.Thread(target=read_log, daemon=True),
+               threading.Thread(target=read_progress, daemon=True)]
+    for t in readers:
+        t.start()
+
+    stalled = False
+    published = time.monotonic()
+    while True:
+        try:
+            proc.wait(timeout=min(interval, stall_timeout or interval, 5))
+            break
+        except subprocess.TimeoutExpired:
+            pass
+        now = time.monotonic()
+        with lock:
+            progress = dict(state['progress'])
+            moved = state['moved']
+        if stall_timeout and now - moved > stall_timeout:
+            logger.warning(f"ffmpeg (pid {proc.pid}) made no progress for {stall_timeout} seconds, killing it")
+            stalled = True
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # it exited on its own in the meantime
+                pass
+            proc.wait()
+            break
+        if callback is not None and progress and now - published >= interval:
+            published = now
+            try:
+                callback(progress)
+            except Exception as e:
+                logger.debug(f"Progress callback failed: {e}")
+
+    for t in readers:
+        t.join()
+    return proc.returncode, stalled, "\n".join(tail)
+
+
+class TranscodeScheduler:
+    """
+    Run transcode jobs from any number of packages, giving each job an
+    explicit thread budget so that the total matches the number of cores.
+
+    Queued jobs are started most expensive first.  A job is started when a
+    slot and at least one core are free, and it gets an even share of the
+    free cores among the jobs that could be started right now (but no more
+    than max_threads).  The function for the job is called with a 'threads'
+    keyword argument.
+    """
+    def __init__(self, cores=None, max_jobs=None, max_threads=None):
+        self.cores = cores or os.cpu_count() or 1
+        self.max_jobs = max_jobs or self.cores
+        self.max_threads = max_threads or self.cores
+        self.free = self.cores
+        self.running = 0
+        self.queue = []  # heap of (-cost, sequence, future, fn, args, kwargs)
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix="transcode")
+
+    def submit(self, cost, fn, *args, **kwargs):
+        "Queue a job with the given cost.  Returns a Future for the result"
+        return self.submit_many([(cost, fn, args, kwargs)])[0]
+
+    def submit_many(self, jobs):
+        """Queue a list of (cost, fn, args, kwargs) jobs all at once, so the
+           first one doesn't get all of the cores.  Returns a list of Futures"""
+        futures = []
+        with self.lock:
+            for cost, fn, args, kwargs in jobs:
+                future = Future()
+                self.sequence += 1
+                heapq.heappush(self.queue, (-cost, self.sequence, future, fn, args, kwargs))
+                futures.append(future)
+        self._dispatch()
+        return futures
+
+    def _dispatch(self):
+        "Start as many queued jobs as there are slots and cores for"
+        with self.lock:
+            while self.queue and self.running < self.max_jobs and self.free > 0:
+                _, _, future, fn, args, kwargs = heapq.heappop(self.queue)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                startable = min(len(self.queue) + 1, self.max_jobs - self.running)
+                threads = max(1, min(self.max_threads, self.free // startable))
+                self.free -= threads
+                self.running += 1
+                self.executor.submit(self._run, threads, future, fn, args, kwargs)
+
+    def _run(self, threads, future, fn, args, kwargs):
+        try:
+            future.set_result(fn(*args, threads=threads, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.free += threads
+                self.running -= 1
+                self.idle.notify_all()
+            self._dispatch()
+
+    def shutdown(self, wait=True):
+        "Shut down the scheduler, waiting for all of the queued jobs to finish"
+        if wait:
+            with self.lock:
+                while self.queue or self.running:
+                    self.idle.wait()
+        self.executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
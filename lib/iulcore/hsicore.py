@@ -1,8 +1,10 @@
 import os
 import stat
 import subprocess
+import threading
 import time
 import re
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime
 import signal
@@ -10,6 +12,10 @@ import logging
 
 logger = logging.getLogger()
 
+# commands written to HSI at once by run_batch.  The output of a group is
+# read before the next is written so neither pipe can fill up.
+BATCH_SIZE = 100
+
 class HSIError(Exception):
     """An HSI error of some sort"""
 
@@ -48,12 +54,9 @@ class HSICore:
                         self.keyTab, "-l", self.userName, "pwd"], capture_output=True, encoding='utf-8')
         return result.returncode == 0 and str(result.stdout).startswith("pwd0")
 
-    def run_command(self, command, cos=None):
+    def _connect(self):
         """
-        Issue an HSI command and capture the capture_output
-
-        command:  a list representing the command
-        cos:  optional class-of-service to use for the command
+        Make sure there is a running HSI process for this process
         """
         if self.pid != os.getpid():
             self.connection = None
@@ -95,13 +98,80 @@ class HSICore:
                     logger.debug(f"HSI local pwd: {localPwd}, sentinel: {sentinel}")
                     self.sentinel = sentinel
 
+    def healthy(self):
+        """
+        Check that the session still works by running pwd in it.  A session
+        whose process has gone away is respawned by this
+        """
+        try:
+            lines = self.run_command(["pwd"])
+            return bool(lines) and lines[0].startswith("pwd0")
+        except Exception as e:
+            logger.debug(f"HSI health check failed: {e}")
+            return False
+
+    def close(self):
+        """
+        End the HSI session
+        """
+        if self.connection is not None and self.pid == os.getpid():
+            try:
+                print("quit", file=self.connection.stdin)
+                self.connection.stdin.close()
+                self.connection.wait(timeout=10)
+            except Exception:
+                self.connection.kill()
+                self.connection.wait()
+        self.connection = None
+
+    def _format(self, command, cos=None):
         cmd = " ".join(command)
         if cos is not None:
             cmd += f" cos={cos}"
-        cmd += "; id"
+        return cmd
+
+    def run_command(self, command, cos=None):
+        """
+        Issue an HSI command and capture the capture_output
+
+        command:  a list representing the command
+        cos:  optional class-of-service to use for the command
+        """
+        self._connect()
+        cmd = self._format(command, cos)
         logger.debug(f"Running HSI command: {cmd}")
-        print(cmd, file=self.connection.stdin)
+        print(cmd + "; id", file=self.connection.stdin)
         self.connection.stdin.flush()
+        return self._read_result(cmd)
+
+    def run_batch(self, commands, cos=None, batch_size=BATCH_SIZE):
+        """
+        Issue several HSI commands without waiting for each one to finish.
+        They are written batch_size at a time, each followed by the id
+        sentinel so the output can be split back up.
+
+        Returns a list with the output lines of each command, in order, or
+        the HSIError for the commands which failed
+        """
+        self._connect()
+        results = []
+        for i in range(0, len(commands), batch_size):
+            cmds = [self._format(c, cos) for c in commands[i:i + batch_size]]
+            logger.debug(f"Running {len(cmds)} HSI commands: {cmds}")
+            for cmd in cmds:
+                print(cmd + "; id", file=self.connection.stdin)
+            self.connection.stdin.flush()
+            for cmd in cmds:
+                try:
+                    results.append(self._read_result(cmd))
+                except HSIError as e:
+                    results.append(e)
+        return results
+
+    def _read_result(self, cmd):
+        """
+        Read the output of a command up to the sentinel
+        """
         lines = []
         line = None
         exception = None
@@ -522,6 +592,35 @@ class HSICore:
             self.run_command(["migrate", ("-F" if force else ""),
                               self.initDir + self.clean_path(path)])
 
+    def put_many(self, files, dirs=(), cos=None):
+        """
+        Create the directories (in order) and put a list of (local path,
+        remote path) files, reading back the stored checksums, all as one
+        batch.  Returns a dict of remote path -> checksum (None if it isn't
+        set) or the HSIError if the file couldn't be stored
+        """
+        commands = [["mkdir", "-p", self.initDir + self.clean_path(d)] for d in dirs]
+        for lpath, rpath in files:
+            commands.append(["put", "-c", "on", "-H", "md5", lpath, ":", self.initDir + self.clean_path(rpath)] +
+                            ([f"cos={cos}"] if cos is not None else []))
+            commands.append(["hashlist", self.initDir + self.clean_path(rpath)])
+        results = self.run_batch(commands)
+        for d, r in zip(dirs, results):
+            if isinstance(r, HSIError):
+                raise r
+        checksums = {}
+        for n, (lpath, rpath) in enumerate(files):
+            put, hashlist = results[len(dirs) + 2 * n:len(dirs) + 2 * n + 2]
+            if isinstance(put, HSIError):
+                checksums[rpath] = put
+            elif isinstance(hashlist, HSIError):
+                checksums[rpath] = hashlist
+            elif not hashlist or hashlist[0].startswith("(none)"):
+                checksums[rpath] = None
+            else:
+                checksums[rpath] = hashlist[0][0:32]
+        return checksums
+
     def get_checksum(self, path):
         """
         Get the checksum for a path, or None if it is a dir or not set.
@@ -587,3 +686,137 @@ class HSICore:
                                 stderr=subprocess.DEVNULL,
                                 text=False)
         return proc.stdout
+
+
+class HSIPool:
+    """
+    A pool of persistent HSI sessions which threads can check out, so the
+    keytab authentication and session setup are only done once per
+    session instead of once per use.
+
+    At most max_size sessions exist at a time, and a thread waits for one
+    to be returned when they are all in use.  Sessions which have been
+    idle for more than idle_timeout seconds are closed, and a session
+    which has been idle for more than health_interval seconds is checked
+    with pwd when it is checked out (it is replaced if that fails).  A
+    session is thrown away if anything other than an HSIError escapes
+    while it is checked out, since it may not be at the sentinel.
+    """
+
+    def __init__(self, initDir, max_size=4, idle_timeout=300, health_interval=60, **kwargs):
+        self.initDir = initDir
+        self.kwargs = kwargs
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.idle = []  # (last used, session), most recent last
+        self.size = 0
+        self.pid = os.getpid()
+        self.lock = threading.Condition()
+        self.stopped = threading.Event()
+        threading.Thread(target=self._reaper, daemon=True, name="hsi-pool").start()
+
+    def _check_fork(self):
+        # sessions can't be shared with a parent process
+        if self.pid != os.getpid():
+            self.idle = []
+            self.size = 0
+            self.pid = os.getpid()
+
+    def _reaper(self):
+        while not self.stopped.wait(max(1, self.idle_timeout / 2)):
+            self.evict_idle()
+
+    def evict_idle(self):
+        """
+        Close the sessions which have been idle too long
+        """
+        with self.lock:
+            self._check_fork()
+            now = time.time()
+            expired = [s for t, s in self.idle if now - t > self.idle_timeout]
+            self.idle = [(t, s) for t, s in self.idle if now - t <= self.idle_timeout]
+            self.size -= len(expired)
+            if expired:
+                self.lock.notify_all()
+        for s in expired:
+            logger.debug("Closing idle HSI session")
+            s.close()
+
+    def checkout(self):
+        """
+        Get a session from the pool, creating one if there is room
+        """
+        with self.lock:
+            self._check_fork()
+            while not self.idle and self.size >= self.max_size:
+                self.lock.wait()
+            if self.idle:
+                last_used, session = self.idle.pop()
+            else:
+                last_used, session = None, None
+                self.size += 1
+        try:
+            if session is None:
+                session = HSICore(self.initDir, **self.kwargs)
+            elif time.time() - last_used > self.health_interval and not session.healthy():
+                logger.warning("HSI session failed its health check, starting a new one")
+                session.close()
+                session = HSICore(self.initDir, **self.kwargs)
+        except BaseException:
+            with self.lock:
+                self.size -= 1
+                self.lock.notify()
+            raise
+        return session
+
+    def checkin(self, session, discard=False):
+        """
+        Return a session to the pool, or close it if it shouldn't be reused
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            if discard or self.stopped.is_set():
+                self.size -= 1
+            else:
+                self.idle.append((time.time(), session))
+            self.lock.notify()
+        if discard or self.stopped.is_set():
+            session.close()
+
+    @contextmanager
+    def session(self):
+        """
+        Check out a session for the duration of a with block
+        """
+        session = self.checkout()
+        try:
+            yield session
+        except HSIError:
+            self.checkin(session)
+            raise
+        except BaseException:
+            self.checkin(session, discard=True)
+            raise
+        else:
+            self.checkin(session)
+
+    def close(self):
+        """
+        Close all of the idle sessions.  Sessions which are checked out are
+        closed when they are returned
+        """
+        self.stopped.set()
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+        for _, s in idle:
+            s.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
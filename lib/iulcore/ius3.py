@@ -1,58 +1,126 @@
 """
 API for interacting with the Hitachi Content Platform S3 at IU
 """
-import boto3
-import boto3.session
-from botocore.utils import fix_s3_host
-from botocore.client import Config
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import base64
-from datetime import datetime
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# multipart defaults: 64M parts, 4 parts at a time for each object
+PART_SIZE = 64 * 1024 * 1024
+CONCURRENCY = 4
+
+# seconds a prefix inventory is good for
+INVENTORY_TTL = 300
+
+# the most keys S3 will take in one delete_objects request
+DELETE_BATCH = 1000
 
 
 class IUS3:
-    def __init__(self, username, password, hostname, bucket):
+    """
+    An HCP bucket.  A single client (with its connection pool) is used for
+    everything, and it is safe to share an IUS3 between threads.
+    """
+    def __init__(self, username, password, hostname, bucket, part_size=None,
+                 concurrency=None, max_connections=None, inventory_ttl=None):
+        # boto3 is slow to import, so only do it when it's used
+        import boto3.session
+        from boto3.s3.transfer import TransferConfig
+        from botocore.utils import fix_s3_host
+        from botocore.client import Config
         url = f"https://{hostname}/"
         secret = hashlib.md5(password.encode()).hexdigest()
-        id = base64.b64encode(username.encode()).decode()        
+        id = base64.b64encode(username.encode()).decode()
+        part_size = part_size or PART_SIZE
+        concurrency = concurrency or CONCURRENCY
         config = Config(s3={'addressing_style': 'path',
                             'payload_signing_enabled': 'yes'},
-                            signature_version='s3v4')
+                            signature_version='s3v4',
+                            max_pool_connections=max_connections or concurrency * 4)
         session = boto3.session.Session(
             aws_access_key_id=id,
             aws_secret_access_key=secret,
             region_name=None
         )
-        self.s3 = session.resource('s3', endpoint_url=url,                            
-                                   config=config)
-        self.s3.meta.client.meta.events.unregister('before-sign.s3', fix_s3_host)     
-        self.bucket = self.s3.Bucket(bucket)
+        self.s3 = session.client('s3', endpoint_url=url,
+                                 config=config)
+        self.s3.meta.events.unregister('before-sign.s3', fix_s3_host)
+        self.bucket_name = bucket
+        self.transfer_config = TransferConfig(multipart_threshold=part_size,
+                                              multipart_chunksize=part_size,
+                                              max_concurrency=concurrency,
+                                              use_threads=True)
+        # upload this many objects at once in put_many
+        self.parallel_objects = max(1, (max_connections or concurrency * 4) // concurrency)
+        # prefix -> (time listed, {key: object info})
+        self.inventories = {}
+        self.inventory_ttl = INVENTORY_TTL if inventory_ttl is None else inventory_ttl
+        self.inventory_lock = threading.Lock()
 
 
     def list_objects(self, prefix=None):
         """Get objects with a given prefix"""
-        for x in self.bucket.objects.filter(Prefix=prefix):
-            yield {'bucket_name': x.bucket_name, 
-                   'key': x.key,
-                   'last_modified': x.last_modified,
-                   'e_tag': x.e_tag,
-                   'size': x.size}
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix or ''):
+            for x in page.get('Contents', []):
+                yield {'bucket_name': self.bucket_name,
+                       'key': x['Key'],
+                       'last_modified': x['LastModified'],
+                       'e_tag': x['ETag'],
+                       'size': x['Size']}
+
+    def inventory(self, prefix):
+        """Get the objects under a prefix as a dict of key -> object info.  The
+           listing is cached for inventory_ttl seconds, and objects put or
+           deleted through this client are kept up to date in it"""
+        with self.inventory_lock:
+            cached = self.inventories.get(prefix)
+            if cached is None or time.time() - cached[0] > self.inventory_ttl:
+                cached = (time.time(), {x['key']: x for x in self.list_objects(prefix)})
+                self.inventories[prefix] = cached
+            return cached[1]
+
+    def lookup(self, objectname, prefix):
+        "Get the object info for an object from the inventory of a prefix, or None"
+        return self.inventory(prefix).get(objectname)
+
+    def _remember(self, objectname, info):
+        "Update the cached inventories for an object which was put (or deleted, if info is None)"
+        with self.inventory_lock:
+            for prefix, (_, objects) in self.inventories.items():
+                if objectname.startswith(prefix):
+                    if info is None:
+                        objects.pop(objectname, None)
+                    else:
+                        objects[objectname] = info
+
+    @staticmethod
+    def etag_matches(e_tag, md5):
+        """Check if an ETag is the md5 of the content.  Multipart uploads have
+           ETags which aren't, so they never match"""
+        e_tag = (e_tag or '').strip('"')
+        return '-' not in e_tag and md5 is not None and e_tag.lower() == md5.lower()
 
     def stat(self, objectname):
         try:
-            x = self.bucket.Object(objectname)
-            return {'bucket_name': x.bucket_name, 
-                    'key': x.key,
-                    'last_modified': x.last_modified.timestamp(),
-                    'e_tag': x.e_tag,
-                    'size': x.content_length}
+            x = self.s3.head_object(Bucket=self.bucket_name, Key=objectname)
+            return {'bucket_name': self.bucket_name,
+                    'key': objectname,
+                    'last_modified': x['LastModified'].timestamp(),
+                    'e_tag': x['ETag'],
+                    'size': x['ContentLength'],
+                    'metadata': x.get('Metadata', {})}
         except Exception as e:
             return None
 
 
     def exists(self, objectname):
         try:
-            x = self.bucket.Object(objectname).e_tag
+            self.s3.head_object(Bucket=self.bucket_name, Key=objectname)
             return True
         except Exception as e:
             return False
@@ -60,19 +128,81 @@ class IUS3:
 
     def get(self, objectname, handle):
         "get a file using a file-like object"
-        self.bucket.download_fileobj(objectname, handle)
-
-    def put(self, objectname, handle):
-        "put a file using a file-like object"
-        self.bucket.upload_fileobj(handle, objectname)
+        self.s3.download_fileobj(self.bucket_name, objectname, handle, Config=self.transfer_config)
+
+    def get_many(self, files):
+        """Download a list of (objectname, local path) in parallel.  Returns a
+           dict of objectname -> either an exception or the size, seconds and
+           rate (bytes/second) of the download"""
+        def download(objectname, path):
+            start = time.time()
+            with open(path, "wb") as handle:
+                self.get(objectname, handle)
+            seconds = time.time() - start
+            size = os.path.getsize(path)
+            return {'size': size, 'seconds': seconds, 'rate': size / seconds if seconds else 0}
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.parallel_objects) as tpe:
+            futures = {objectname: tpe.submit(download, objectname, path) for objectname, path in files}
+            for objectname, f in futures.items():
+                try:
+                    results[objectname] = f.result()
+                except Exception as e:
+                    results[objectname] = e
+        return results
+
+    def put(self, objectname, handle, md5=None):
+        "put a file using a file-like object.  If the md5 is known it is stored in the object metadata"
+        extra = {'Metadata': {'md5': md5}} if md5 else None
+        self.s3.upload_fileobj(handle, self.bucket_name, objectname, ExtraArgs=extra, Config=self.transfer_config)
+
+    def put_many(self, files):
+        """Upload a list of (objectname, local path, md5 or None) in parallel.
+           Returns a dict of objectname -> either an exception or the size,
+           seconds and rate (bytes/second) of the upload"""
+        def upload(objectname, path, md5):
+            start = time.time()
+            with open(path, "rb") as handle:
+                self.put(objectname, handle, md5)
+            seconds = time.time() - start
+            size = os.path.getsize(path)
+            self._remember(objectname, {'bucket_name': self.bucket_name,
+                                        'key': objectname,
+                                        'last_modified': datetime.now(timezone.utc),
+                                        'e_tag': None,
+                                        'size': size})
+            return {'size': size, 'seconds': seconds, 'rate': size / seconds if seconds else 0}
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.parallel_objects) as tpe:
+            futures = {objectname: tpe.submit(upload, objectname, path, md5) for objectname, path, md5 in files}
+            for objectname, f in futures.items():
+                try:
+                    results[objectname] = f.result()
+                except Exception as e:
+                    results[objectname] = e
+        return results
 
     def delete(self, objectname):
         "delete an object"
-        self.bucket.Object(objectname).delete()
-        
-
-
-
-
-
-
+        self.s3.delete_object(Bucket=self.bucket_name, Key=objectname)
+        self._remember(objectname, None)
+
+    def delete_many(self, objectnames):
+        """Delete objects with as few requests as possible (DELETE_BATCH keys
+           per request).  Returns a dict of objectname -> error message for
+           the objects which couldn't be deleted"""
+        objectnames = list(objectnames)
+        errors = {}
+        for i in range(0, len(objectnames), DELETE_BATCH):
+            batch = objectnames[i:i + DELETE_BATCH]
+            result = self.s3.delete_objects(Bucket=self.bucket_name,
+                                            Delete={'Objects': [{'Key': k} for k in batch],
+                                                    'Quiet': True})
+            for e in result.get('Errors', []):
+                errors[e['Key']] = f"{e.get('Code')}: {e.get('Message')}"
+            for k in batch:
+                if k not in errors:
+                    self._remember(k, None)
+        return errors
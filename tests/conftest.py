@@ -0,0 +1,67 @@
+"""
+Shared fixtures.  The tools run against an in-memory database and a
+configuration built by each test.
+"""
+from pathlib import Path
+import importlib.machinery
+import importlib.util
+import sys
+import mongomock
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "lib"))
+sys.path.insert(0, str(ROOT / "bin"))
+
+import ami
+from ami import Ami
+
+
+class FakeAmi(Ami):
+    "An Ami rooted in a scratch directory with an in-memory database"
+    def __init__(self, root, config, application):
+        self.application = application
+        self.root = Path(root)
+        self.config_path = self.root / "etc"
+        self.config = config
+        self.db = mongomock.MongoClient().get_database(config['mongodb']['database'])
+
+    def get_db(self):
+        return self.db
+
+    def set_proc_title(self, application=None, action=None):
+        pass
+
+
+def make_config(**apps):
+    return {'mongodb': {'database': 'ami', 'write_behind': 0, 'lease_time': 300},
+            'directories': {'dropbox': 'dropbox',
+                            'workspace': 'workspace',
+                            'finished': 'finished',
+                            'retrieval': 'retrieval',
+                            'metadata': 'metadata'},
+            'apps': apps}
+
+
+@pytest.fixture
+def make_ami(tmp_path):
+    "Make an Ami for an application with the given application configurations"
+    def make(application="test", **apps):
+        fake = FakeAmi(tmp_path, make_config(**apps), application)
+        for d in fake.config['directories'].values():
+            (tmp_path / d).mkdir(exist_ok=True)
+        return fake
+    return make
+
+
+@pytest.fixture
+def load_tool(monkeypatch):
+    "Load a tool from bin as a module, using the given Ami"
+    def load(name, fake):
+        monkeypatch.setattr(ami, 'Ami', lambda *args, **kwargs: fake)
+        loader = importlib.machinery.SourceFileLoader(name, str(ROOT / "bin" / name))
+        spec = importlib.util.spec_from_loader(name, loader)
+        module = importlib.util.module_from_spec(spec)
+        loader.exec_module(module)
+        return module
+    return load
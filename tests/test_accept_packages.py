@@ -0,0 +1,275 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import os
+import threading
+import zipfile
+import pytest
+from ami.package_factory import PackageFactory
+
+CONFIG = {'concurrent_md5s': 2}
+
+
+@pytest.fixture
+def accept(make_ami, load_tool):
+    fake = make_ami("accept_packages", accept_packages=CONFIG)
+    return load_tool("accept_packages", fake)
+
+
+def make_bag(dropbox, pkg_id, files, algorithms=('md5', 'sha256')):
+    "Make a bag with manifests for the files (name -> content) in data"
+    pkgdir = dropbox / pkg_id
+    (pkgdir / "data").mkdir(parents=True)
+    (pkgdir / "bagit.txt").write_text("BagIt-Version: 0.97\n")
+    (pkgdir / "bag-info.txt").write_text(f"Payload-Oxum: {sum(len(x) for x in files.values())}.{len(files)}\n")
+    (pkgdir / "marc.xml").write_text("<record/>")
+    for name, content in files.items():
+        (pkgdir / "data" / name).write_bytes(content)
+    for algorithm in algorithms:
+        with open(pkgdir / f"manifest-{algorithm}.txt", "w") as f:
+            for name, content in files.items():
+                f.write(f"{hashlib.new(algorithm, content).hexdigest()}  data/{name}\n")
+    return pkgdir
+
+
+def make_zip(dropbox, pkg_id):
+    z = dropbox / f"{pkg_id}.zip"
+    data = b"media" * 100
+    with zipfile.ZipFile(z, "w") as zfile:
+        zfile.writestr(f"{pkg_id}/bagit.txt", "BagIt-Version: 0.97\n")
+        zfile.writestr(f"{pkg_id}/manifest-md5.txt", f"{hashlib.md5(data).hexdigest()}  data/media.mkv\n")
+        zfile.writestr(f"{pkg_id}/data/media.mkv", data)
+    return z
+
+
+def test_failed_ingest_leaves_nothing_in_the_workspace(make_ami, load_tool, monkeypatch):
+    fake = make_ami("accept_packages", accept_packages=CONFIG)
+    tool = load_tool("accept_packages", fake)
+    z = make_zip(fake.get_directory("dropbox"), "40000000000001")
+
+    def broken(z, zfile, members, digests, pkgdir, signatures, md5s):
+        (pkgdir / "data").mkdir(parents=True)
+        (pkgdir / "data" / "media.mkv").write_bytes(b"med")
+        raise OSError("No space left on device")
+    monkeypatch.setattr(tool, 'extract_members', broken)
+    tool.ingest_zip(z)
+
+    pkg = PackageFactory(fake).get_package("40000000000001")
+    assert pkg.get_state() == "local_failed"
+    assert list(fake.get_directory("workspace").iterdir()) == []
+    # the zip is still there to try again
+    assert z.exists()
+
+
+def test_ingest_sets_the_title_once_from_the_main_thread(make_ami, load_tool, tmp_path, monkeypatch):
+    fake = make_ami("accept_packages", accept_packages=dict(CONFIG, parallel_extract_size=1))
+    tool = load_tool("accept_packages", fake)
+    pkgdir = make_bag(tmp_path, "40000000000013", {'a.mkv': b"aaaa", 'b.mkv': b"bbbb", 'mets.xml': b"<mets/>"})
+    z = fake.get_directory("dropbox") / "40000000000013.zip"
+    with zipfile.ZipFile(z, "w") as zfile:
+        for f in sorted(pkgdir.glob("**/*")):
+            if f.is_file():
+                zfile.write(f, str(f.relative_to(tmp_path)))
+    titles = []
+    monkeypatch.setattr(fake, 'set_proc_title', lambda **kw: titles.append((threading.current_thread(), kw)))
+    tool.ingest_zip(z)
+
+    assert PackageFactory(fake).get_package("40000000000013").get_state() == "accepted"
+    assert titles == [(threading.main_thread(), {'action': "ingesting 40000000000013"})]
+
+
+def test_manifests_are_combined_and_every_digest_is_checked(accept, tmp_path):
+    pkgdir = make_bag(tmp_path / "dropbox", "40000000000002", {'a.mkv': b"aaaa", 'mets.xml': b"<mets/>"})
+    digests = accept.load_manifests(pkgdir)
+    assert set(digests) == {'data/a.mkv', 'data/mets.xml'}
+    assert digests['data/a.mkv'] == {'md5': hashlib.md5(b"aaaa").hexdigest(),
+                                     'sha256': hashlib.sha256(b"aaaa").hexdigest()}
+
+    error, signature, md5 = accept.verify_file(pkgdir, 'data/a.mkv', digests['data/a.mkv'])
+    assert error is None
+    assert signature is not None
+    assert md5 == hashlib.md5(b"aaaa").hexdigest()
+
+    # a good md5 doesn't hide a bad sha256
+    bad = dict(digests['data/a.mkv'], sha256="0" * 64)
+    error, _, md5 = accept.verify_file(pkgdir, 'data/a.mkv', bad)
+    assert error.startswith("Invalid sha256 for data/a.mkv")
+    assert md5 is None
+
+
+def test_manifest_problems(accept, tmp_path):
+    digests = {}
+    accept.parse_manifest("manifest-SHA256.txt", ["ABCD  data/a b.mkv\n", "\n"], digests)
+    assert digests == {'data/a b.mkv': {'sha256': 'abcd'}}
+    with pytest.raises(ValueError):
+        accept.parse_manifest("manifest-md5.txt", ["abcd\n"], {})
+    with pytest.raises(ValueError):
+        accept.parse_manifest("manifest-nosuchhash.txt", [], {})
+
+    pkgdir = make_bag(tmp_path / "dropbox", "40000000000003", {'a.mkv': b"aaaa"}, algorithms=())
+    (pkgdir / "tagmanifest-md5.txt").write_text(f"{hashlib.md5(b'x').hexdigest()}  bagit.txt\n")
+    with pytest.raises(ValueError):
+        accept.load_manifests(pkgdir)
+
+    # a file in the manifest which isn't in the bag
+    error, signature, md5 = accept.verify_file(pkgdir, 'data/b.mkv', {'md5': "0" * 32})
+    assert error.startswith("IOError")
+    assert signature is None and md5 is None
+
+
+def test_checksum_mismatch_fails_validation(accept, tmp_path):
+    pkgdir = make_bag(tmp_path / "dropbox", "40000000000004", {'a.mkv': b"aaaa", 'mets.xml': b"<mets/>"})
+    (pkgdir / "data" / "a.mkv").write_bytes(b"aaab")
+    with ThreadPoolExecutor(max_workers=2) as tpe:
+        queue = accept.ValidationQueue(PackageFactory(accept.ami), tpe, 2)
+        queue.add(pkgdir)
+        while queue.busy():
+            queue.run(timeout=10)
+    pkg = PackageFactory(accept.ami).get_package("40000000000004")
+    assert pkg.get_state() == "validation_failed"
+    assert any("Invalid md5 for data/a.mkv" in x['message'] for x in pkg.get_logs())
+    assert pkgdir.exists()
+
+
+class InlineExecutor:
+    "Runs each job as it is submitted, remembering the order"
+    def __init__(self):
+        self.order = []
+
+    def submit(self, fn, *args):
+        self.order.append((args[0].stem, args[1]))
+        f = Future()
+        f.set_result(fn(*args))
+        return f
+
+
+def test_validation_queue_verifies_the_largest_files_first(accept, tmp_path):
+    dropbox = tmp_path / "dropbox"
+    executor = InlineExecutor()
+    queue = accept.ValidationQueue(PackageFactory(accept.ami), executor, 1)
+    queue.add(make_bag(dropbox, "40000000000005.transferred", {'a.mkv': b"a" * 30, 'mets.xml': b"<mets/>"}))
+    queue.add(make_bag(dropbox, "40000000000006.transferred", {'b.mkv': b"b" * 50, 'c.mkv': b"c" * 10, 'mets.xml': b"<mets/>"}))
+    while queue.busy():
+        queue.run()
+    assert [x for x in executor.order if not x[1].endswith("mets.xml")] == [
+        ("40000000000006", "data/b.mkv"), ("40000000000005", "data/a.mkv"), ("40000000000006", "data/c.mkv")]
+
+
+def test_validation_queue_finishes_each_package_once(accept, tmp_path, monkeypatch):
+    dropbox = tmp_path / "dropbox"
+    finished = []
+    finish = accept.ValidationQueue.finish
+    monkeypatch.setattr(accept.ValidationQueue, 'finish',
+                        lambda self, record: finished.append(record['pkg'].get_id()) or finish(self, record))
+    good = make_bag(dropbox, "40000000000007.transferred", {'a.mkv': b"aaaa", 'mets.xml': b"<mets/>"})
+    bad = make_bag(dropbox, "40000000000008.transferred", {'a.mkv': b"aaaa", 'b.mkv': b"bbbb", 'mets.xml': b"<mets/>"})
+    (bad / "data" / "a.mkv").write_bytes(b"aaab")
+    (bad / "data" / "b.mkv").write_bytes(b"bbbc")
+    notbag = make_bag(dropbox, "40000000000009.transferred", {'a.mkv': b"aaaa"})
+    (notbag / "bagit.txt").unlink()
+
+    with ThreadPoolExecutor(max_workers=2) as tpe:
+        queue = accept.ValidationQueue(PackageFactory(accept.ami), tpe, 2)
+        for pkgdir in (good, bad, notbag):
+            queue.add(pkgdir)
+        # a package which can't be a bag is finished without any jobs
+        assert finished == ["40000000000009"]
+        while queue.busy():
+            queue.run(timeout=10)
+
+    assert sorted(finished) == ["40000000000007", "40000000000008", "40000000000009"]
+    pf = PackageFactory(accept.ami)
+    assert pf.get_package("40000000000007").get_state() == "accepted"
+    assert pf.get_package("40000000000008").get_state() == "validation_failed"
+    assert pf.get_package("40000000000009").get_state() == "validation_failed"
+    errors = [x['message'] for x in pf.get_package("40000000000008").get_logs() if x['severity'] == 'error']
+    assert "Invalid md5 for data/a.mkv" in errors[0] and "Invalid md5 for data/b.mkv" in errors[0]
+
+
+def test_drained_validation_queue_lets_the_pool_shut_down(accept, tmp_path):
+    pkgdir = make_bag(tmp_path / "dropbox", "40000000000010.transferred", {'a.mkv': b"aaaa", 'mets.xml': b"<mets/>"})
+    tpe = ThreadPoolExecutor(max_workers=2)
+    queue = accept.ValidationQueue(PackageFactory(accept.ami), tpe, 2)
+    queue.add(pkgdir)
+    assert queue.pkgdirs == {pkgdir}
+    while queue.busy():
+        queue.run(timeout=10)
+    assert queue.running == {} and queue.jobs == [] and queue.pkgdirs == set()
+    tpe.shutdown(wait=True)
+    # with nothing left to do, running doesn't wait on the (closed) pool
+    queue.run()
+    assert not queue.busy()
+
+
+class FakeInotify:
+    "Hands out watch descriptors, the events are made by the tests"
+    def __init__(self):
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        self.watches[len(self.watches) + 1] = path
+        return len(self.watches)
+
+    def rm_watch(self, wd):
+        self.watches.pop(wd)
+
+
+def test_dropbox_entries_settle_after_a_quiet_period(accept, tmp_path, monkeypatch):
+    from ami.inotify import IN_CREATE, IN_ISDIR, IN_MODIFY, IN_DELETE, IN_Q_OVERFLOW
+    clock = [1000]
+    monkeypatch.setattr(accept, 'time', lambda: clock[0])
+    dropbox = tmp_path / "dropbox"
+    inotify = FakeInotify()
+    watcher = accept.DropboxWatcher(inotify, dropbox)
+
+    (dropbox / "p.transferred" / "data").mkdir(parents=True)
+    watcher.handle([(watcher.root, IN_CREATE | IN_ISDIR, 0, "p.transferred"),
+                    (watcher.root, IN_CREATE, 0, "notes.txt")])
+    assert list(watcher.pending) == ["p.transferred"]
+    wd = next(wd for wd, (_, path) in watcher.watches.items() if path.name == "data")
+
+    # writes deep in the tree count as activity
+    clock[0] = 1050
+    watcher.handle([(wd, IN_MODIFY, 0, "media.mkv")])
+    assert watcher.settled(1100 - 60) == []
+    assert watcher.next_deadline(60) == 1110
+    assert watcher.settled(1110 - 60) == ["p.transferred"]
+
+    # removing an entry stops watching it
+    watcher.handle([(watcher.root, IN_DELETE | IN_ISDIR, 0, "p.transferred")])
+    assert watcher.pending == {} and watcher.watches == {}
+    assert list(inotify.watches) == [watcher.root]
+    assert watcher.next_deadline(60) == float('inf')
+
+    watcher.handle([(-1, IN_Q_OVERFLOW, 0, "")])
+    assert watcher.overflowed
+
+
+def test_watch_rescans_without_inotify(accept, tmp_path, monkeypatch):
+    monkeypatch.setattr(accept, 'my_config', dict(CONFIG, concurrent_unzips=1, settle=60, rescan=600))
+    dropbox = tmp_path / "dropbox"
+    old = make_bag(dropbox, "40000000000011.transferred", {'a.mkv': b"aaaa", 'mets.xml': b"<mets/>"})
+    os.utime(old, (0, 0))
+    make_bag(dropbox, "40000000000012.transferred", {'a.mkv': b"aaaa", 'mets.xml': b"<mets/>"})
+
+    def unavailable():
+        raise OSError(24, "Too many open files")
+
+    class Stop(Exception):
+        pass
+
+    sleeps = []
+
+    def sleep(t):
+        sleeps.append(t)
+        raise Stop()
+    monkeypatch.setattr(accept, 'Inotify', unavailable)
+    monkeypatch.setattr(accept, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr(accept, 'sleep', sleep)
+    pf = PackageFactory(accept.ami)
+    with pytest.raises(Stop):
+        accept.watch(pf, dropbox)
+
+    # only the quiet package was picked up, and the next look is within the settle time
+    assert pf.package_exists("40000000000011")
+    assert not pf.package_exists("40000000000012")
+    assert 0 < sleeps[0] <= 60
@@ -0,0 +1,70 @@
+import json
+from ami import Ami
+
+
+def config_ami(tmp_path, text):
+    (tmp_path / "etc").mkdir(exist_ok=True)
+    (tmp_path / "var").mkdir(exist_ok=True)
+    (tmp_path / "etc" / "ami.conf").write_text(text)
+    a = Ami.__new__(Ami)
+    a.root = tmp_path
+    a.config_path = tmp_path / "etc"
+    return a
+
+
+def test_config_cache_follows_the_file(tmp_path):
+    a = config_ami(tmp_path, "apps:\n  test:\n    value: 1\n")
+    assert a.load_config() == {'apps': {'test': {'value': 1}}}
+    cachefile = tmp_path / "var" / "ami.conf.cache"
+    assert cachefile.stat().st_mode & 0o077 == 0
+
+    # the cache is used while the file is the same...
+    cached = json.loads(cachefile.read_text())
+    cached['config']['apps']['test']['value'] = 'cached'
+    cachefile.write_text(json.dumps(cached))
+    assert a.load_config()['apps']['test']['value'] == 'cached'
+
+    # ...and is ignored once the content changes, even with the same size
+    (tmp_path / "etc" / "ami.conf").write_text("apps:\n  test:\n    value: 2\n")
+    assert a.load_config()['apps']['test']['value'] == 2
+
+
+def test_config_cache_ignores_bad_caches(tmp_path):
+    a = config_ami(tmp_path, "apps:\n  test:\n    value: 1\n")
+    cachefile = tmp_path / "var" / "ami.conf.cache"
+    cachefile.write_bytes(b"\x80\x04not json")
+    assert a.load_config() == {'apps': {'test': {'value': 1}}}
+
+
+def test_config_which_json_changes_is_not_cached(tmp_path):
+    a = config_ami(tmp_path, "apps:\n  test:\n    1: one\n")
+    assert a.load_config() == {'apps': {'test': {1: 'one'}}}
+    assert not (tmp_path / "var" / "ami.conf.cache").exists()
+    assert a.load_config() == {'apps': {'test': {1: 'one'}}}
+
+
+def test_first_database_use_sets_the_title_and_migrates_once(tmp_path, monkeypatch):
+    import sys
+    import mongomock
+    import pymongo
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(pymongo, "MongoClient", lambda **kw: client)
+    monkeypatch.setattr(sys, "db", None, raising=False)
+    a = config_ami(tmp_path, "")
+    a.config = {'mongodb': {'connection': {}, 'database': 'ami'}}
+    a.titled = False
+    titles = []
+    a.set_proc_title = lambda: titles.append(True)
+
+    db = a.get_db()
+    assert titles == [True]
+    assert 'migrations' in db.list_collection_names()
+    assert 'latest_1_state_1_state_change_1' in db.packages.index_information()
+
+    # a new connection (as in a forked child) doesn't look at the indexes again
+    calls = []
+    monkeypatch.setattr(mongomock.collection.Collection, "index_information",
+                        lambda self: calls.append(self.name) or {})
+    sys.db = None
+    a.get_db()
+    assert calls == []
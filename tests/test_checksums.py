@@ -0,0 +1,70 @@
+import hashlib
+import io
+import os
+import threading
+import pytest
+from ami.checksums import ChecksumLedger, copy_and_hash, hash_file
+from ami.package import Package
+
+
+@pytest.fixture
+def ledger(make_ami):
+    fake = make_ami()
+    return ChecksumLedger(fake, Package.create(fake, "40000000000001", "accepted"))
+
+
+def test_hash_file_computes_every_digest(tmp_path):
+    f = tmp_path / "f"
+    f.write_bytes(b"x" * 1000)
+    assert hash_file(f, ('md5', 'sha256'), blocksize=64) == {'md5': hashlib.md5(b"x" * 1000).hexdigest(),
+                                                            'sha256': hashlib.sha256(b"x" * 1000).hexdigest()}
+
+
+def test_copy_and_hash(tmp_path):
+    dst = io.BytesIO()
+    assert copy_and_hash(io.BytesIO(b"data" * 100), dst, blocksize=7) == {'md5': hashlib.md5(b"data" * 100).hexdigest()}
+    assert dst.getvalue() == b"data" * 100
+    abort = threading.Event()
+    abort.set()
+    with pytest.raises(InterruptedError):
+        copy_and_hash(io.BytesIO(b"data"), io.BytesIO(), abort=abort)
+
+
+def test_ledger_remembers_checksums(ledger, tmp_path, monkeypatch):
+    f = tmp_path / "f"
+    f.write_bytes(b"data")
+    assert ledger.lookup("pkg/f", f) is None
+    assert ledger.md5("pkg/f", f) == hashlib.md5(b"data").hexdigest()
+    # the second time it comes from the ledger
+    monkeypatch.setattr("ami.checksums.md5_file", lambda path: pytest.fail("the file was hashed again"))
+    assert ledger.md5("pkg/f", f) == hashlib.md5(b"data").hexdigest()
+
+
+def test_ledger_notices_changed_files(ledger, tmp_path):
+    f = tmp_path / "f"
+    f.write_bytes(b"data")
+    ledger.md5("pkg/f", f)
+    # same size, different content and mtime
+    f.write_bytes(b"atad")
+    os.utime(f, ns=(0, 0))
+    assert ledger.lookup("pkg/f", f) is None
+    assert ledger.md5("pkg/f", f) == hashlib.md5(b"atad").hexdigest()
+    # a new file in its place
+    f.unlink()
+    (tmp_path / "g").write_bytes(b"atad")
+    (tmp_path / "g").rename(f)
+    assert ledger.lookup("pkg/f", f) is None
+    f.unlink()
+    assert ledger.lookup("pkg/f", f) is None
+
+
+def test_ledger_is_per_package(make_ami, tmp_path):
+    fake = make_ami()
+    f = tmp_path / "f"
+    f.write_bytes(b"data")
+    ledger = ChecksumLedger(fake, Package.create(fake, "40000000000001"))
+    ledger.record("pkg/f", f, "ABC")
+    assert ledger.lookup("pkg/f", f) == "abc"
+    assert ChecksumLedger(fake, Package.create(fake, "40000000000002")).lookup("pkg/f", f) is None
+    # a new version of the package starts with an empty ledger
+    assert ChecksumLedger(fake, Package.create(fake, "40000000000001")).lookup("pkg/f", f) is None
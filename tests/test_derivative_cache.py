@@ -0,0 +1,139 @@
+import hashlib
+import sys
+import threading
+import time
+import pytest
+from ami import derivative_cache
+from ami.derivative_cache import DerivativeCache
+from ami.package import Package
+
+# A stand-in for ffmpeg: the output is made from the arguments and written
+# in place (like ffmpeg -y), then progress is reported as finished.
+FFMPEG = f'''#!{sys.executable}
+import os
+import sys
+if sys.argv[1] == "-version":
+    print("ffmpeg version test")
+    sys.exit(0)
+with open(sys.argv[-1], "r+" if os.path.exists(sys.argv[-1]) else "w") as f:
+    f.truncate()
+    f.write(" ".join(sys.argv[1:-1]))
+print("progress=end", flush=True)
+'''
+
+FFPROBE = f'''#!{sys.executable}
+print('<ffprobe><format duration="1.0"/></ffprobe>')
+'''
+
+
+def store(cache, key, path, data):
+    path.write_bytes(data)
+    cache.store(key, path, "<ffprobe/>", hashlib.md5(data).hexdigest())
+
+
+def test_key_depends_on_everything():
+    key = DerivativeCache.key("ABC", "-c:v  libx264", "v1")
+    assert key == DerivativeCache.key("abc", "-c:v libx264", "v1")
+    assert key != DerivativeCache.key("abd", "-c:v libx264", "v1")
+    assert key != DerivativeCache.key("abc", "-c:v libx265", "v1")
+    assert key != DerivativeCache.key("abc", "-c:v libx264", "v2")
+    assert key != DerivativeCache.key("abc", "-c:v libx264", "v1", "multi")
+    # made one at a time, the key is the one from before there were modes
+    old = hashlib.sha256()
+    for part in ("abc", "-c:v libx264", "v1"):
+        old.update(part.encode('utf-8') + b'\0')
+    assert key == old.hexdigest()
+
+
+def test_store_and_fetch(tmp_path):
+    cache = DerivativeCache(tmp_path / "cache", 10 ** 6)
+    store(cache, "k1", tmp_path / "a.mp4", b"data")
+    out = tmp_path / "b.mp4"
+    out.write_bytes(b"old")
+    data = cache.fetch("k1", out)
+    assert data == {'ffprobe': "<ffprobe/>", 'md5': hashlib.md5(b"data").hexdigest()}
+    assert out.read_bytes() == b"data"
+    assert cache.fetch("k2", tmp_path / "c.mp4") is None
+
+
+def test_threads_can_store_the_same_key_at_once(tmp_path, monkeypatch):
+    cache = DerivativeCache(tmp_path / "cache", 10 ** 6)
+    staged = []
+    both = threading.Barrier(2, timeout=5)
+    link_or_copy = derivative_cache.link_or_copy
+
+    def staging(src, dst):
+        link_or_copy(src, dst)
+        staged.append(dst.name)
+        both.wait()
+    monkeypatch.setattr(derivative_cache, 'link_or_copy', staging)
+
+    errors = []
+
+    def worker(name):
+        try:
+            store(cache, "k1", tmp_path / name, b"data")
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker, args=(name,)) for name in ("a.mp4", "b.mp4")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert len(set(staged)) == 2
+    # nothing is left behind from the staging
+    assert sorted(x.name for x in (tmp_path / "cache" / "k1").iterdir()) == ["k1.json", "k1.mp4"]
+    monkeypatch.setattr(derivative_cache, 'link_or_copy', link_or_copy)
+    assert cache.fetch("k1", tmp_path / "out.mp4") is not None
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = DerivativeCache(tmp_path / "cache", 250)
+    for key in ("k1", "k2"):
+        store(cache, key, tmp_path / f"{key}.mp4", b"x" * 100)
+        time.sleep(0.01)
+    # using k1 makes k2 the oldest
+    assert cache.fetch("k1", tmp_path / "out.mp4") is not None
+    time.sleep(0.01)
+    store(cache, "k3", tmp_path / "k3.mp4", b"x" * 100)
+    assert cache.fetch("k2", tmp_path / "out.mp4") is None
+    assert cache.fetch("k1", tmp_path / "out.mp4") is not None
+    assert cache.fetch("k3", tmp_path / "out.mp4") is not None
+
+
+def test_reencoding_does_not_change_cache_entries(make_ami, load_tool, tmp_path):
+    fake = make_ami("process_packages", process_packages={})
+    tool = load_tool("process_packages", fake)
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text(FFMPEG)
+    ffprobe = tmp_path / "ffprobe"
+    ffprobe.write_text(FFPROBE)
+    for f in (ffmpeg, ffprobe):
+        f.chmod(0o755)
+
+    pkg = Package.create(fake, "40000000000001", "processing")
+    pkgdir = fake.get_directory("workspace") / pkg.get_dirname()
+    generated = pkgdir / "generated"
+    generated.mkdir(parents=True)
+    source = pkgdir / "source.mkv"
+    source.write_bytes(b"source")
+    cache = DerivativeCache(tmp_path / "cache", 10 ** 6)
+
+    outfile, _ = tool.transcode_file(pkg, source, "high", generated, str(ffmpeg), "-profile one",
+                                     str(ffprobe), cache)
+    first = outfile.read_bytes()
+    # the ffmpeg log isn't kept when it worked
+    assert not list(generated.glob("*.log"))
+    # a cache hit links the entry into the workspace...
+    outfile.unlink()
+    tool.transcode_file(pkg, source, "high", generated, str(ffmpeg), "-profile one", str(ffprobe), cache)
+    assert outfile.read_bytes() == first
+    # ...and making the derivative with another profile mustn't touch it
+    tool.transcode_file(pkg, source, "high", generated, str(ffmpeg), "-profile two", str(ffprobe), cache)
+    assert b"two" in outfile.read_bytes()
+    key = DerivativeCache.key(hashlib.md5(b"source").hexdigest(), "-profile one", "ffmpeg version test")
+    check = tmp_path / "check.mp4"
+    data = cache.fetch(key, check)
+    assert check.read_bytes() == first
+    assert data['md5'] == hashlib.md5(first).hexdigest()
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import pytest
+from ami.package import Package
+from iulcore.ius3 import IUS3
+
+CONFIG = {'concurrent_dists': 1,
+          'switchyard': {'url': 'http://localhost', 'token': 'x', 'unit': 'UNIT',
+                         'retries': 3, 'retry_interval': 1},
+          'streaming': {'rtmp': 'rtmp://server/{NAME}', 'http': 'http://server/{NAME}'},
+          'hcp': {'retries': 3, 'retry_interval': 1}}
+
+
+class FakeHCP:
+    "Just enough of IUS3 for distribute_package"
+    etag_matches = staticmethod(IUS3.etag_matches)
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+
+    def lookup(self, objectname, prefix):
+        return self.objects.get(objectname)
+
+    def put_many(self, files):
+        results = {}
+        for objectname, path, md5 in files:
+            data = path.read_bytes()
+            self.uploads.append(objectname)
+            self.objects[objectname] = {'key': objectname, 'size': len(data),
+                                        'e_tag': f'"{hashlib.md5(data).hexdigest()}"'}
+            results[objectname] = {'size': len(data), 'seconds': 1, 'rate': len(data)}
+        return results
+
+
+class FakeSwitchyard:
+    def __init__(self):
+        self.submitted = []
+
+    def submit_group(self, group, data):
+        self.submitted.append((group, data))
+
+
+@pytest.fixture
+def setup(make_ami, load_tool):
+    fake = make_ami("distribute_packages", distribute_packages=CONFIG)
+    tool = load_tool("distribute_packages", fake)
+    pkg = Package.create(fake, "40000000000001", "processed")
+    generated = fake.get_directory("workspace") / pkg.get_dirname() / "generated"
+    generated.mkdir(parents=True)
+    (generated / "a_high.mp4").write_bytes(b"high" * 100)
+    (generated / "a_low.mp4").write_bytes(b"low" * 100)
+    (generated / f"{pkg.get_id()}.json").write_text(json.dumps({
+        'metadata': {},
+        'parts': [{'files': {'1': {'q': {'high': {'filename': 'a_high.mp4'},
+                                         'low': {'filename': 'a_low.mp4'}}}}}]}))
+    return tool, pkg, generated
+
+
+def distribute(tool, pkg, hcp, sy):
+    tool.distribute_package(pkg, hcp, sy)
+    assert pkg.get_state() == 'dist_waiting'
+    return {q['filename']: q['url_http']
+            for q in sy.submitted[-1][1]['parts'][0]['files']['1']['q'].values()}
+
+
+def test_first_distribution_uploads_everything(setup):
+    tool, pkg, generated = setup
+    hcp, sy = FakeHCP(), FakeSwitchyard()
+    urls = distribute(tool, pkg, hcp, sy)
+    assert len(hcp.uploads) == 2
+    hcp_files = pkg.get_app_data('hcp_files')
+    for name in ('a_high.mp4', 'a_low.mp4'):
+        assert hcp_files[name].startswith("UNIT/") and hcp_files[name].endswith("_" + name)
+        assert hcp_files[name] in hcp.uploads
+        assert urls[name] == "http://server/" + hcp_files[name]
+
+
+def test_unchanged_derivatives_are_reused(setup):
+    tool, pkg, generated = setup
+    hcp, sy = FakeHCP(), FakeSwitchyard()
+    first = distribute(tool, pkg, hcp, sy)
+    pkg.set_state('processed')
+    second = distribute(tool, pkg, hcp, sy)
+    assert len(hcp.uploads) == 2
+    assert first == second
+
+
+def test_changed_derivative_is_pushed_again(setup):
+    tool, pkg, generated = setup
+    hcp, sy = FakeHCP(), FakeSwitchyard()
+    first = distribute(tool, pkg, hcp, sy)
+    (generated / "a_low.mp4").write_bytes(b"new" * 100)
+    pkg.set_state('processed')
+    second = distribute(tool, pkg, hcp, sy)
+    assert len(hcp.uploads) == 3
+    assert second['a_high.mp4'] == first['a_high.mp4']
+    assert second['a_low.mp4'] != first['a_low.mp4']
+
+
+def test_multipart_objects_use_the_recorded_md5(setup):
+    tool, pkg, generated = setup
+    hcp, sy = FakeHCP(), FakeSwitchyard()
+    distribute(tool, pkg, hcp, sy)
+    for o in hcp.objects.values():
+        o['e_tag'] = '"0123456789abcdef0123456789abcdef-2"'
+    pkg.set_state('processed')
+    distribute(tool, pkg, hcp, sy)
+    assert len(hcp.uploads) == 2
+
+
+def test_missing_object_is_pushed_again(setup):
+    tool, pkg, generated = setup
+    hcp, sy = FakeHCP(), FakeSwitchyard()
+    distribute(tool, pkg, hcp, sy)
+    hcp.objects.clear()
+    pkg.set_state('processed')
+    distribute(tool, pkg, hcp, sy)
+    assert len(hcp.uploads) == 4
@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta, timezone
+from ami.package import Package
+
+CONFIG = {'switchyard': {'unit': 'UNIT'}, 'hcp': {}}
+
+
+class FakeHCP:
+    "Just enough of IUS3 for gc"
+    def __init__(self, keys):
+        old = datetime.now(timezone.utc) - timedelta(days=7)
+        self.objects = {k: {'key': k, 'size': 10, 'last_modified': old} for k in keys}
+
+    def list_objects(self, prefix):
+        return [o for k, o in sorted(self.objects.items()) if k.startswith(prefix)]
+
+    def delete_many(self, keys):
+        for k in keys:
+            del self.objects[k]
+        return {}
+
+
+def test_gc_only_removes_unreferenced_distributed_keys(make_ami, load_tool):
+    fake = make_ami("hcpcli", distribute_packages=CONFIG)
+    tool = load_tool("hcpcli", fake)
+    pkg = Package.create(fake, "40000000000001", "finished")
+    pkg.set_app_data('hcp_files', {'a_high.mp4': 'UNIT/20200101000000000000_a_high.mp4'}, 'distribute_packages')
+    pkg.flush()
+    hcp = FakeHCP(['UNIT/20200101000000000000_a_high.mp4',   # in use
+                   'UNIT/20190101000000000000_a_high.mp4',   # an old upload
+                   'UNIT/manual/a_high.mp4',                 # put there with sync
+                   'UNIT/notes.txt'])                        # or put
+    assert tool.gc(hcp, 'UNIT/', 24, 1000, 1, False)
+    assert sorted(hcp.objects) == ['UNIT/20200101000000000000_a_high.mp4', 'UNIT/manual/a_high.mp4', 'UNIT/notes.txt']
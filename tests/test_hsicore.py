@@ -0,0 +1,145 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+import pytest
+
+# the HSICore defaults come from the environment when it is imported
+os.environ.setdefault('USER', 'ami')
+from iulcore.hsicore import HSICore, HSIError, HSIPool, BATCH_SIZE
+
+# A stand-in for an hsi session: each command's output is followed by the
+# output of id, which is the sentinel.  Puts of anything named 'bad' fail,
+# and hashlist reports the md5 of the remote path.
+HSI = f'''#!{sys.executable}
+import hashlib
+import sys
+for line in sys.stdin:
+    for c in [x.strip() for x in line.split(';')]:
+        if c == 'pwd':
+            print("pwd0: /hpss/ami")
+        elif c == 'lpwd':
+            print("lpwd0: /tmp")
+        elif c == 'glob':
+            print("filename globbing is on")
+        elif c.startswith('idletime'):
+            print("idle time is unlimited")
+            print("")
+        elif c == 'id':
+            print("uid=1000(ami)")
+        elif c.startswith('put') and 'bad' in c:
+            print("*** put: Error -2 on transfer.  " + c.split()[-1])
+        elif c.startswith('hashlist') and 'bad' in c:
+            print("*** hashlist: HPSS_ENOENT " + c.split()[-1])
+        elif c.startswith('hashlist'):
+            print(hashlib.md5(c.split()[-1].encode()).hexdigest() + " md5 " + c.split()[-1])
+        elif c.startswith('ls'):
+            print("*** ls: " + c.split()[-1] + ": HPSS_ENOENT")
+        elif c == 'quit':
+            sys.exit(0)
+    sys.stdout.flush()
+'''
+
+
+@pytest.fixture
+def hsi(tmp_path):
+    "Make the arguments for HSICore which use the stand-in"
+    binary = tmp_path / "hsi"
+    binary.write_text(HSI)
+    binary.chmod(0o755)
+    keytab = tmp_path / "keytab"
+    keytab.write_text("")
+    return {'hsiBinary': str(binary), 'keyTab': str(keytab), 'userName': 'ami'}
+
+
+def md5(path):
+    return hashlib.md5(path.encode()).hexdigest()
+
+
+def test_run_batch_keeps_the_results_in_order(hsi):
+    h = HSICore("/sda", **hsi)
+    commands = [["hashlist", f"/sda/f{i}"] for i in range(BATCH_SIZE * 2 + 5)]
+    commands[7] = ["put", "-c", "on", "/l/bad", ":", "/sda/bad"]
+    commands[8] = ["ls", "/sda/missing"]
+    results = h.run_batch(commands)
+    assert len(results) == len(commands)
+    assert isinstance(results[7], HSIError)
+    # errors which don't matter give no output rather than an exception
+    assert results[8] == []
+    assert results[9] == [f"{md5('/sda/f9')} md5 /sda/f9"]
+    assert results[-1] == [f"{md5(f'/sda/f{len(commands) - 1}')} md5 /sda/f{len(commands) - 1}"]
+    # the session is still in step afterwards
+    assert h.run_command(["pwd"]) == ["pwd0: /hpss/ami"]
+    h.close()
+
+
+def test_put_many_reports_each_file(hsi):
+    h = HSICore("/sda", **hsi)
+    files = [(f"/l/f{i}", f"pkg/f{i}") for i in range(BATCH_SIZE)] + [("/l/bad", "pkg/bad")]
+    results = h.put_many(files, ["pkg", "pkg/data"])
+    assert len(results) == len(files)
+    assert results["pkg/f0"] == md5("/sda/pkg/f0")
+    assert results[f"pkg/f{BATCH_SIZE - 1}"] == md5(f"/sda/pkg/f{BATCH_SIZE - 1}")
+    assert isinstance(results["pkg/bad"], HSIError)
+    h.close()
+
+
+def test_pool_shares_a_limited_number_of_sessions(hsi):
+    pool = HSIPool("/sda", max_size=2, **hsi)
+    sessions = set()
+    in_use = []
+    most = []
+
+    def work():
+        for _ in range(5):
+            with pool.session() as h:
+                in_use.append(h)
+                most.append(len(in_use))
+                sessions.add(id(h))
+                h.put_many([("/l/a", "pkg/a")])
+                in_use.remove(h)
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(sessions) <= 2 and max(most) <= 2
+    assert pool.size == len(pool.idle) <= 2
+    pool.close()
+    assert pool.size == 0
+
+
+def test_pool_replaces_broken_sessions(hsi):
+    pool = HSIPool("/sda", max_size=1, health_interval=0, **hsi)
+    with pool.session() as h:
+        h.run_command(["pwd"])
+        first = h.connection
+    first.kill()
+    first.wait()
+    # the health check notices and the session is started again
+    with pool.session() as h:
+        assert h.run_command(["pwd"]) == ["pwd0: /hpss/ami"]
+        assert h.connection is not first
+
+    # a session which might be in the middle of a command isn't reused...
+    with pytest.raises(RuntimeError):
+        with pool.session() as h:
+            raise RuntimeError("interrupted")
+    assert pool.size == 0
+    # ...but one whose command failed is
+    with pytest.raises(HSIError):
+        with pool.session() as h:
+            h.run_command(["put", "/l/bad", ":", "/sda/bad"])
+    assert pool.size == 1
+    pool.close()
+
+
+def test_pool_closes_idle_sessions(hsi):
+    pool = HSIPool("/sda", idle_timeout=0.1, **hsi)
+    with pool.session() as h:
+        h.run_command(["pwd"])
+    time.sleep(0.2)
+    pool.evict_idle()
+    assert pool.size == 0 and h.connection is None
+    pool.close()
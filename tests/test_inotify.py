@@ -0,0 +1,25 @@
+import pytest
+from ami.inotify import Inotify, IN_CHANGES, IN_CREATE, IN_DELETE, IN_IGNORED
+
+
+def test_inotify_reports_changes(tmp_path):
+    with Inotify() as inotify:
+        wd = inotify.add_watch(tmp_path, IN_CHANGES)
+        assert inotify.read_events() == []
+        (tmp_path / "a.zip").write_bytes(b"zip")
+        (tmp_path / "a.zip").unlink()
+        events = inotify.read_events()
+        assert (wd, IN_CREATE, 0, "a.zip") == events[0]
+        assert events[-1] == (wd, IN_DELETE, 0, "a.zip")
+
+        inotify.rm_watch(wd)
+        assert [x[1] & IN_IGNORED for x in inotify.read_events()] == [IN_IGNORED]
+        # removing it again is harmless
+        inotify.rm_watch(wd)
+
+
+def test_inotify_refuses_missing_paths(tmp_path):
+    with Inotify() as inotify:
+        with pytest.raises(OSError) as e:
+            inotify.add_watch(tmp_path / "missing")
+        assert e.value.filename == str(tmp_path / "missing")
@@ -0,0 +1,114 @@
+from datetime import datetime, timezone
+import hashlib
+import io
+import threading
+import pytest
+from iulcore.ius3 import IUS3
+
+
+class FakeS3:
+    "Just enough of an S3 client for the transfers.  Keys starting with 'bad' fail"
+    def __init__(self, parallel):
+        self.objects = {}
+        self.configs = []
+        self.metadata = {}
+        self.active = 0
+        self.most = 0
+        self.lock = threading.Lock()
+        # every good transfer waits for the others that should be running with it
+        self.barrier = threading.Barrier(parallel, timeout=5)
+
+    def _transfer(self, key, config):
+        with self.lock:
+            self.configs.append(config)
+            self.active += 1
+            self.most = max(self.most, self.active)
+        try:
+            if key.startswith("bad"):
+                raise IOError(f"Cannot transfer {key}")
+            self.barrier.wait()
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def upload_fileobj(self, handle, bucket, key, ExtraArgs=None, Config=None):
+        self._transfer(key, Config)
+        self.objects[key] = handle.read()
+        self.metadata[key] = (ExtraArgs or {}).get('Metadata', {})
+
+    def download_fileobj(self, bucket, key, handle, Config=None):
+        self._transfer(key, Config)
+        handle.write(self.objects[key])
+
+    def get_paginator(self, name):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                yield {'Contents': [{'Key': k, 'LastModified': datetime(2020, 1, 1, tzinfo=timezone.utc),
+                                     'ETag': '"etag"', 'Size': len(v)}
+                                    for k, v in s3.objects.items() if k.startswith(Prefix)]}
+        return Paginator()
+
+
+@pytest.fixture
+def hcp():
+    return IUS3("user", "password", "hcp.example.org", "bucket", part_size=8 * 1024 * 1024,
+                concurrency=2, max_connections=4)
+
+
+def test_transfer_config_comes_from_the_settings(hcp):
+    assert hcp.transfer_config.multipart_threshold == 8 * 1024 * 1024
+    assert hcp.transfer_config.multipart_chunksize == 8 * 1024 * 1024
+    assert hcp.transfer_config.max_concurrency == 2
+    assert hcp.s3.meta.config.max_pool_connections == 4
+    # the connections are shared by the objects in flight
+    assert hcp.parallel_objects == 2
+
+    defaults = IUS3("user", "password", "hcp.example.org", "bucket")
+    assert defaults.transfer_config.multipart_chunksize == 64 * 1024 * 1024
+    assert defaults.s3.meta.config.max_pool_connections == 16
+    assert defaults.parallel_objects == 4
+
+
+def test_put_many_and_get_many(hcp, tmp_path):
+    hcp.s3 = FakeS3(hcp.parallel_objects)
+    hcp.s3.objects['unit/old'] = b"old"
+    assert list(hcp.inventory('unit/')) == ['unit/old']
+
+    files = []
+    for i in range(4):
+        (tmp_path / f"f{i}").write_bytes(b"x" * (i + 1))
+        files.append((f"unit/f{i}", tmp_path / f"f{i}", hashlib.md5(b"x" * (i + 1)).hexdigest()))
+    files.append(("bad/f", tmp_path / "f0", None))
+    files.append(("unit/missing", tmp_path / "missing", None))
+    results = hcp.put_many(files)
+    assert [results[f"unit/f{i}"]['size'] for i in range(4)] == [1, 2, 3, 4]
+    assert isinstance(results["bad/f"], IOError)
+    assert isinstance(results["unit/missing"], FileNotFoundError)
+    assert hcp.s3.metadata['unit/f1'] == {'md5': hashlib.md5(b"xx").hexdigest()}
+    assert all(c is hcp.transfer_config for c in hcp.s3.configs)
+    assert hcp.s3.most == 2
+
+    # the uploads are in the inventory, with times comparable to the listed ones
+    inventory = hcp.inventory('unit/')
+    assert sorted(inventory) == ['unit/f0', 'unit/f1', 'unit/f2', 'unit/f3', 'unit/old']
+    assert max(x['last_modified'] for x in inventory.values()) > datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    hcp.s3.configs.clear()
+    results = hcp.get_many([(f"unit/f{i}", tmp_path / f"copy{i}") for i in range(4)] +
+                           [("bad/f", tmp_path / "copy_bad")])
+    assert [(tmp_path / f"copy{i}").read_bytes() for i in range(4)] == [b"x", b"xx", b"xxx", b"xxxx"]
+    assert results["unit/f2"]['size'] == 3
+    assert isinstance(results["bad/f"], IOError)
+    assert all(c is hcp.transfer_config for c in hcp.s3.configs)
+
+
+def test_get_and_put_use_the_transfer_config(hcp):
+    hcp.s3 = FakeS3(1)
+    hcp.put("unit/a", io.BytesIO(b"abc"))
+    assert hcp.s3.metadata['unit/a'] == {}
+    out = io.BytesIO()
+    hcp.get("unit/a", out)
+    assert out.getvalue() == b"abc"
+    assert hcp.s3.configs == [hcp.transfer_config, hcp.transfer_config]
@@ -0,0 +1,127 @@
+import random
+import xml.etree.ElementTree as ET
+from ami.metadata import Metadata, prettify, denamespace, marc_date_issued, ead_date_issued, stream_find
+from ami.mets import Mets
+
+MARC = '''<?xml version="1.0"?>
+<collection xmlns="http://www.loc.gov/MARC21/slim">
+  <record>
+    <leader>00000cjm a2200000 a 4500</leader>
+    <datafield tag="245" ind1="1" ind2="0"><subfield code="a">A title</subfield></datafield>
+    <datafield tag="100" ind1="0" ind2=" "><subfield code="d">1800-1870</subfield></datafield>
+    <datafield tag="100" ind1="1" ind2=" "><subfield code="a">Someone</subfield><subfield code="d">1901-1988</subfield></datafield>
+    <datafield tag="100" ind1="1" ind2=" "><subfield code="d">1950-</subfield></datafield>
+  </record>
+</collection>
+'''
+
+EAD = '''<?xml version="1.0"?>
+<ead xmlns="urn:isbn:1-931666-22-9">
+  <archdesc level="series"><did><unittitle>Series<unitdate>1700</unitdate></unittitle></did></archdesc>
+  <archdesc level="collection">
+    <did><unittitle>Papers, <unitdate>1921-1950</unitdate></unittitle></did>
+    <dsc><c01><did><unittitle>Box<unitdate>1930</unitdate></unittitle></did></c01></dsc>
+  </archdesc>
+</ead>
+'''
+
+METS = '''<?xml version="1.0"?>
+<mets xmlns="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <dmdSec ID="DMD1">
+    <mdRef LOCTYPE="URL" MDTYPE="MARC" xlink:href="http://example.org/marc/1"/>
+    <mdRef LOCTYPE="URL" xlink:href="http://example.org/other"/>
+  </dmdSec>
+  <dmdSec ID="DMD2"><mdRef MDTYPE="EAD" xlink:href="http://example.org/ead/2"/></dmdSec>
+</mets>
+'''
+
+def quadratic_prettify(element, indent='  '):
+    "The original prettify, which the linear one has to match"
+    queue = [(0, element)]
+    while queue:
+        level, element = queue.pop(0)
+        children = [(level + 1, child) for child in list(element)]
+        if children:
+            element.text = '\n' + indent * (level+1)
+        if queue:
+            element.tail = '\n' + indent * queue[0][0]
+        else:
+            element.tail = '\n' + indent * (level-1)
+        queue[0:0] = children
+
+
+def test_prettify():
+    root = ET.fromstring("<a><b><c/><d/></b><e/></a>")
+    prettify(root)
+    assert ET.tostring(root).decode() == "<a>\n  <b>\n    <c />\n    <d />\n  </b>\n  <e />\n</a>\n"
+
+
+def test_prettify_matches_the_original():
+    rnd = random.Random(1)
+    root = ET.Element("root")
+    elements = [root]
+    for i in range(500):
+        elements.append(ET.SubElement(rnd.choice(elements), f"e{i}"))
+    text = ET.tostring(root)
+    a, b = ET.fromstring(text), ET.fromstring(text)
+    prettify(a)
+    quadratic_prettify(b)
+    assert ET.tostring(a) == ET.tostring(b)
+
+
+def test_prettify_deep_and_wide():
+    root = ET.Element("root")
+    for i in range(2000):
+        ET.SubElement(ET.SubElement(root, "x"), "y")
+    prettify(root)
+    assert root[0].text == "\n    " and root[0].tail == "\n  " and root[-1].tail == "\n"
+
+
+def test_lookups_only_check_the_spreadsheets_now_and_then(tmp_path, monkeypatch):
+    (tmp_path / "titles.csv").write_text("Barcode,Title\n40000000000001,First\n")
+    metadata = Metadata(tmp_path, refresh_interval=60)
+    checks = []
+    changes = metadata._changes
+    monkeypatch.setattr(metadata, '_changes', lambda db: checks.append(1) or changes(db))
+    assert metadata.lookup_title("40000000000001") == "First"
+    looked = len(checks)
+    (tmp_path / "titles.csv").write_text("Barcode,Title\n40000000000001,Second title\n")
+    assert metadata.lookup_title("40000000000001") == "First"
+    assert len(checks) == looked
+    metadata.refreshed -= 60
+    assert metadata.lookup_title("40000000000001") == "Second title"
+
+
+def full_tree_marc_date(marcfile, default=None):
+    "The original MARC 100 lookup, which the streaming one has to match"
+    tree = denamespace(marcfile)
+    for marc100 in tree.findall("record/datafield[@tag='100']"):
+        if marc100.attrib.get('ind1', '') == '1' and marc100.attrib.get('ind2', '') == ' ':
+            return marc100.find("subfield[@code='d']").text.split('-', 1)[0]
+    return default
+
+
+def test_streaming_lookups_match_the_full_tree(tmp_path):
+    marcfile = tmp_path / "marc.xml"
+    marcfile.write_text(MARC)
+    assert marc_date_issued(marcfile, "default") == full_tree_marc_date(marcfile, "default") == "1901"
+    marcfile.write_text(MARC.replace('ind1="1"', 'ind1="2"'))
+    assert marc_date_issued(marcfile, "default") == full_tree_marc_date(marcfile, "default") == "default"
+
+    eadfile = tmp_path / "ead.xml"
+    eadfile.write_text(EAD)
+    tree = denamespace(eadfile)
+    assert ead_date_issued(eadfile) == tree.find("archdesc[@level='collection']/did/unittitle/unitdate").text.split('-', 1)[0] == "1921"
+    # nothing deeper than the path is matched
+    assert stream_find(eadfile, [(None, {}), ('archdesc', {'level': 'series'}), ('did', {})]).find("{*}unittitle").text == "Series"
+    assert stream_find(eadfile, [(None, {}), ('unitdate', {})]) is None
+
+
+def test_mets_identifiers_match_the_full_tree(tmp_path):
+    metsfile = tmp_path / "mets.xml"
+    metsfile.write_text(METS)
+    tree = denamespace(metsfile)
+    for dmdid in ('DMD1', 'DMD2', 'DMD3'):
+        old = [[x.attrib.get('MDTYPE', 'Unknown'), x.attrib['href']] for x in tree.findall(f"dmdSec[@ID='{dmdid}']/mdRef")]
+        assert Mets(metsfile).dmd_identifiers(dmdid) == old
+    assert Mets(metsfile).dmd_identifiers() == [['MARC', 'http://example.org/marc/1'], ['Unknown', 'http://example.org/other']]
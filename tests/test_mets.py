@@ -0,0 +1,50 @@
+import os
+from ami import mets
+from ami.mets import Mets
+
+METS = '''<?xml version="1.0"?>
+<mets xmlns="http://www.loc.gov/METS/">
+  <fileSec>
+    <fileGrp>
+      <fileGrp USE="production_master"><file ID="{id}" MIMETYPE="video/x-matroska"/></fileGrp>
+    </fileGrp>
+  </fileSec>
+</mets>
+'''
+
+
+def test_parsed_mets_is_reused_until_the_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(mets, "_cache", type(mets._cache)())
+    metsfile = tmp_path / "mets.xml"
+    metsfile.write_text(METS.format(id="a"))
+    first = Mets.load(metsfile)
+    assert Mets.load(tmp_path / "." / "mets.xml") is first
+
+    # a change of size...
+    metsfile.write_text(METS.format(id="abc"))
+    second = Mets.load(metsfile)
+    assert second is not first
+    assert list(second.production_masters()) == ["abc"]
+
+    # ...or just of the mtime
+    metsfile.write_text(METS.format(id="xyz"))
+    s = metsfile.stat()
+    os.utime(metsfile, ns=(s.st_atime_ns, s.st_mtime_ns + 1000000000))
+    third = Mets.load(metsfile)
+    assert third is not second
+    assert list(third.production_masters()) == ["xyz"]
+
+    # callers get their own copy of the files
+    third.production_masters()['xyz']['type'] = "changed"
+    assert Mets.load(metsfile).production_masters()['xyz']['type'] == "video/x-matroska"
+
+
+def test_mets_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(mets, "_cache", type(mets._cache)())
+    monkeypatch.setattr(mets, "CACHE_SIZE", 2)
+    files = []
+    for i in range(3):
+        files.append(tmp_path / f"mets{i}.xml")
+        files[-1].write_text(METS.format(id=i))
+        Mets.load(files[-1])
+    assert list(mets._cache) == [f.resolve() for f in files[1:]]
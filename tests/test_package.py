@@ -0,0 +1,254 @@
+import os
+import time
+import pytest
+from ami import Ami
+from ami.package import Package
+
+
+@pytest.fixture
+def fake(make_ami):
+    return make_ami()
+
+
+def test_create_marks_the_latest_version(fake):
+    db = fake.get_db()
+    db.packages.insert_one({'id': 'p1', 'timestamp': '20200101-000000', 'state': 'finished', '_version': 3})
+    old = Package.create(fake, 'p1')
+    db.packages.update_one({'_id': old.data['_id']}, {'$set': {'timestamp': '20200102-000000'}})
+    new = Package.create(fake, 'p1')
+    flags = {d['timestamp']: d['latest'] for d in db.packages.find({'id': 'p1'})}
+    assert flags == {'20200101-000000': False, '20200102-000000': False, new.get_timestamp(): True}
+
+
+def test_mark_latest_only_touches_unmarked_documents(fake):
+    db = fake.get_db()
+    db.packages.insert_many([
+        {'id': 'p1', 'timestamp': '20200101-000000'},
+        {'id': 'p1', 'timestamp': '20200102-000000'},
+        {'id': 'p2', 'timestamp': '20200101-000000'},
+        # already marked, even if it looks wrong, stays as it is
+        {'id': 'p3', 'timestamp': '20200101-000000', 'latest': True},
+        {'id': 'p3', 'timestamp': '20200102-000000', 'latest': False},
+    ])
+    Ami.mark_latest(db)
+    flags = {(d['id'], d['timestamp']): d['latest'] for d in db.packages.find()}
+    assert flags == {('p1', '20200101-000000'): False,
+                     ('p1', '20200102-000000'): True,
+                     ('p2', '20200101-000000'): True,
+                     ('p3', '20200101-000000'): True,
+                     ('p3', '20200102-000000'): False}
+    # nothing left to do the second time
+    Ami.mark_latest(db)
+    assert flags == {(d['id'], d['timestamp']): d['latest'] for d in db.packages.find()}
+
+
+def test_create_during_backfill_leaves_one_latest(fake):
+    db = fake.get_db()
+    db.packages.insert_one({'id': 'p1', 'timestamp': '20200101-000000', 'state': 'finished', '_version': 3})
+    new = Package.create(fake, 'p1')
+    Ami.mark_latest(db)
+    assert [d['timestamp'] for d in db.packages.find({'id': 'p1', 'latest': True})] == [new.get_timestamp()]
+
+
+def lease(fake, pkg):
+    return fake.get_db().packages.find_one({'_id': pkg.data['_id']}).get('lease')
+
+
+def test_claim_is_exclusive(fake):
+    Package.create(fake, 'p1', 'processed')
+    first = Package(fake, fake.get_db().packages.find_one({'id': 'p1'})['_id'])
+    second = Package(fake, first.data['_id'])
+    assert first.claim('processed', 'distributing')
+    assert not second.claim('processed', 'distributing')
+    assert lease(fake, first)['owner'] == first.lease_owner
+    first.set_state('processed')
+
+
+def test_lease_is_kept_until_the_package_is_handed_off(fake):
+    pkg = Package.create(fake, 'p1', 'processed')
+    assert pkg.claim('processed', 'distributing')
+    owner = pkg.lease_owner
+    pkg.set_state('submitting')
+    assert pkg.get_state() == 'submitting'
+    assert lease(fake, pkg)['owner'] == owner
+    pkg.set_state('dist_waiting')
+    assert pkg.get_state() == 'dist_waiting'
+    assert lease(fake, pkg) is None
+    assert pkg.lease_owner is None
+
+
+def test_lost_lease_stops_state_changes(fake):
+    fake.config['mongodb']['lease_time'] = 0.3
+    pkg = Package.create(fake, 'p1', 'processed')
+    assert pkg.claim('processed', 'distributing')
+    # someone else reclaimed it
+    fake.get_db().packages.update_one({'_id': pkg.data['_id']},
+                                      {'$set': {'state': 'processed', 'lease': None}})
+    deadline = time.time() + 5
+    while not pkg.lease_lost and time.time() < deadline:
+        time.sleep(0.05)
+    assert pkg.lease_lost
+    pkg.set_state('dist_waiting')
+    assert fake.get_db().packages.find_one({'_id': pkg.data['_id']})['state'] == 'processed'
+
+
+def test_external_state_change_takes_the_lease_away(fake):
+    pkg = Package.create(fake, 'p1', 'processed')
+    assert pkg.claim('processed', 'distributing')
+    # an operator moves it while the worker is busy
+    Package(fake, pkg.data['_id']).set_state('processing_failed', external=True)
+    assert lease(fake, pkg) is None
+    pkg.set_state('submitting')
+    pkg.set_state('dist_waiting')
+    assert fake.get_db().packages.find_one({'_id': pkg.data['_id']})['state'] == 'processing_failed'
+    assert pkg.lease_owner is None
+
+
+def test_reset_takes_the_lease_away(fake):
+    pkg = Package.create(fake, 'p1', 'processed')
+    assert pkg.claim('processed', 'distributing')
+    Package(fake, pkg.data['_id']).reset()
+    pkg.set_state('distributed')
+    assert fake.get_db().packages.find_one({'_id': pkg.data['_id']})['state'] == 'accepted'
+
+
+def test_heartbeat_renews_the_lease(fake):
+    fake.config['mongodb']['lease_time'] = 0.3
+    pkg = Package.create(fake, 'p1', 'processed')
+    assert pkg.claim('processed', 'distributing')
+    expires = lease(fake, pkg)['expires']
+    time.sleep(0.5)
+    assert lease(fake, pkg)['expires'] > expires
+    assert Package.reclaim(fake, 'distributing', 'processed') == 0
+    pkg.set_state('processed')
+
+
+def test_expired_leases_are_reclaimed(fake):
+    pkg = Package.create(fake, 'p1', 'processed')
+    assert pkg.claim('processed', 'distributing')
+    pkg.lease_stop.set()
+    fake.get_db().packages.update_one({'_id': pkg.data['_id']}, {'$set': {'lease.expires': time.time() - 1}})
+    assert Package.reclaim(fake, 'distributing', 'processed') == 1
+    assert fake.get_db().packages.find_one({'_id': pkg.data['_id']})['state'] == 'processed'
+    pkg.set_state('dist_waiting')
+    assert fake.get_db().packages.find_one({'_id': pkg.data['_id']})['state'] == 'processed'
+
+
+def v2_package(fake):
+    log = [{'time': f'2020010{i}-000000', 'severity': 'info', 'message': f'entry {i}'} for i in range(1, 4)]
+    return fake.get_db().packages.insert_one({'id': 'p1', 'timestamp': '20200101-000000', 'state': 'finished',
+                                              'latest': True, 'app_data': {}, '_version': 2, 'log': log}).inserted_id
+
+
+def test_log_migration_can_be_repeated(fake, monkeypatch):
+    db = fake.get_db()
+    _id = v2_package(fake)
+    # the copy is done but the version is never flipped
+    real = db.packages.update_one
+    monkeypatch.setattr(db.packages, 'update_one', lambda *a, **kw: (_ for _ in ()).throw(IOError("gone")))
+    with pytest.raises(IOError):
+        Package(fake, _id)
+    assert db.package_logs.count_documents({'package': _id}) == 3
+    assert db.packages.find_one({'_id': _id})['_version'] == 2
+
+    monkeypatch.setattr(db.packages, 'update_one', real)
+    p = Package(fake, _id)
+    assert p.data['_version'] == 3 and 'log' not in p.data
+    assert [x['message'] for x in p.get_logs()] == ['entry 1', 'entry 2', 'entry 3']
+
+
+def test_flush_after_a_partial_log_write(fake, monkeypatch):
+    db = fake.get_db()
+    p = Package.create(fake, 'p1')
+    p.flush_interval = 60
+    p.log('info', 'one')
+    p.log('info', 'two')
+    # the first entry is written and then the connection goes away
+    real = db.package_logs.insert_many
+
+    def partial(entries, **kw):
+        real(entries[:1], **kw)
+        raise IOError("gone")
+    monkeypatch.setattr(db.package_logs, 'insert_many', partial)
+    with pytest.raises(IOError):
+        p.flush()
+
+    monkeypatch.setattr(db.package_logs, 'insert_many', real)
+    p.flush()
+    assert [x['message'] for x in p.get_logs()] == ['Package initialized', 'one', 'two']
+
+
+def wait_for(check, timeout=5):
+    deadline = time.time() + timeout
+    while not check():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def messages(fake, pkg):
+    return [x['message'] for x in fake.get_db().package_logs.find({'package': pkg.data['_id']})]
+
+
+def test_changes_are_written_immediately_by_default(fake):
+    del fake.config['mongodb']['write_behind']
+    p = Package.create(fake, 'p1')
+    p.set_sda_location('sda/p1')
+    assert fake.get_db().packages.find_one({'_id': p.data['_id']})['sda_location'] == 'sda/p1'
+    assert messages(fake, p) == ['Package initialized']
+
+
+def test_write_behind_buffers_until_the_timer(fake):
+    fake.config['mongodb']['write_behind'] = 0.2
+    p = Package.create(fake, 'p1')
+    p.set_sda_location('sda/p1')
+    p.log('info', 'one')
+    assert messages(fake, p) == []
+    wait_for(lambda: messages(fake, p) == ['Package initialized', 'one'])
+    assert fake.get_db().packages.find_one({'_id': p.data['_id']})['sda_location'] == 'sda/p1'
+
+
+def test_failed_timed_flush_is_retried(fake, monkeypatch):
+    fake.config['mongodb']['write_behind'] = 0.1
+    db = fake.get_db()
+    p = Package.create(fake, 'p1')
+    real = db.packages.update_one
+    failures = []
+
+    def flaky(*args, **kwargs):
+        if not failures:
+            failures.append(args)
+            raise IOError("gone")
+        return real(*args, **kwargs)
+    monkeypatch.setattr(db.packages, 'update_one', flaky)
+    p.set_sda_location('sda/p1')
+    wait_for(lambda: messages(fake, p) == ['Package initialized'])
+    assert failures
+    assert db.packages.find_one({'_id': p.data['_id']})['sda_location'] == 'sda/p1'
+
+
+def test_forked_child_drops_the_buffered_changes(fake):
+    fake.config['mongodb']['write_behind'] = 60
+    p = Package.create(fake, 'p1')
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if not p.pending_logs and p.flush_timer is None else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    # the parent still writes them
+    assert p.pending_logs
+    p.flush()
+    assert messages(fake, p) == ['Package initialized']
+
+
+def test_state_change_is_one_update_and_one_log_write(fake, monkeypatch):
+    del fake.config['mongodb']['write_behind']
+    db = fake.get_db()
+    p = Package.create(fake, 'p1')
+    writes = []
+    for collection, method in ((db.packages, 'update_one'), (db.package_logs, 'insert_many')):
+        real = getattr(collection, method)
+        monkeypatch.setattr(collection, method, lambda *a, real=real, method=method, **kw: writes.append(method) or real(*a, **kw))
+    p.set_state('accepted')
+    assert sorted(writes) == ['insert_many', 'update_one']
+    doc = db.packages.find_one({'_id': p.data['_id']})
+    assert doc['state'] == 'accepted' and doc['state_change'] == p.data['state_change']
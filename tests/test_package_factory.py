@@ -0,0 +1,66 @@
+import pytest
+from ami.package import Package, PackageDocument
+from ami.package_factory import PackageFactory, NO_LOGS
+
+
+@pytest.fixture
+def fake(make_ami):
+    return make_ami("package_list")
+
+
+def count_find_one(fake, monkeypatch):
+    "Count the single document fetches made from now on"
+    calls = []
+    find_one = fake.db.packages.find_one
+    monkeypatch.setattr(fake.db.packages, 'find_one', lambda *a, **kw: calls.append(a) or find_one(*a, **kw))
+    return calls
+
+
+def test_projections_keep_the_required_fields():
+    assert PackageFactory._projection(None) is None
+    assert PackageFactory._projection(NO_LOGS) == {'log': 0}
+    # the fields the queries need can't be excluded...
+    assert PackageFactory._projection({'log': 0, 'state': 0, 'app_data': 0}) == {'log': 0, 'app_data': 0}
+    # ...and are always included
+    assert PackageFactory._projection({'state_change': 1}) == {'state_change': 1, '_id': 1, '_version': 1,
+                                                               'id': 1, 'timestamp': 1, 'state': 1}
+
+
+def test_listing_packages_leaves_the_logs_behind(fake, load_tool, monkeypatch, capsys):
+    for pkgid in ('p1', 'p2'):
+        pkg = Package.create(fake, pkgid)
+        # documents from before the package_logs collection carry their logs
+        fake.db.packages.update_one({'_id': pkg.data['_id']}, {'$set': {'log': [{'message': 'x' * 1000}] * 100}})
+
+    packages = list(PackageFactory(fake).find_packages('*', projection=NO_LOGS))
+    assert len(packages) == 2
+    for p in packages:
+        assert isinstance(p.data, PackageDocument)
+        assert dict.__contains__(p.data, 'state_change') and not dict.__contains__(p.data, 'log')
+
+    tool = load_tool("package_list", fake)
+    calls = count_find_one(fake, monkeypatch)
+    monkeypatch.setattr("sys.argv", ["package_list"])
+    tool.main()
+    assert [x.split()[-1] for x in capsys.readouterr().out.splitlines()] == ['transferred', 'transferred']
+    assert calls == []
+
+
+def test_partial_documents_load_fields_when_used(fake, monkeypatch):
+    pkg = Package.create(fake, 'p1')
+    p = PackageFactory(fake).get_package('p1', projection={'state': 1})
+    assert set(dict.keys(p.data)) == {'_id', '_version', 'id', 'timestamp', 'state'}
+
+    calls = count_find_one(fake, monkeypatch)
+    assert p.data['state_change'] == pkg.data['state_change']
+    assert p.data['state_change'] == pkg.data['state_change']
+    assert p.get_state() == 'transferred'
+    # each missing field is fetched once, on its own
+    assert len(calls) == 1 and 'state_change' in calls[0][1] and 'app_data' not in calls[0][1]
+
+    assert p.data.get('nosuchfield', 'default') == 'default'
+    with pytest.raises(KeyError):
+        p.data['nosuchfield']
+
+    # an unprojected fetch is complete
+    assert not isinstance(PackageFactory(fake).get_package('p1').data, PackageDocument)
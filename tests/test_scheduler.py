@@ -0,0 +1,61 @@
+import pytest
+
+TASK = '''
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+def square(x):
+    return x * x
+
+def main():
+    with ProcessPoolExecutor(max_workers=2) as ppe:
+        if list(ppe.map(square, range(4))) != [0, 1, 4, 9]:
+            exit(2)
+    exit(int(os.environ.get("TASK_EXIT", "0")))
+'''
+
+
+@pytest.fixture
+def scheduler(make_ami, load_tool, tmp_path):
+    fake = make_ami("scheduler", scheduler={'lockdir': 'var', 'tasks': []})
+    return load_tool("scheduler", fake)
+
+
+def test_worker_tasks_can_start_processes(scheduler, tmp_path):
+    exefile = tmp_path / "task"
+    exefile.write_text(TASK)
+    w = scheduler.Worker("task", exefile, max_runs=2)
+    try:
+        for _ in range(3):
+            w.run()
+            assert w.conn.poll(60)
+            assert w.finished() == 0
+        # the third run needed a fresh worker
+        assert w.runs == 1
+    finally:
+        w.stop()
+    assert w.process is None
+
+
+def test_stopping_an_idle_worker(scheduler, tmp_path):
+    exefile = tmp_path / "task"
+    exefile.write_text(TASK)
+    w = scheduler.Worker("task", exefile, max_runs=10)
+    w.start()
+    process = w.process
+    w.stop()
+    assert not process.is_alive()
+    assert process.exitcode == 0
+
+
+def test_cron_schedule_ignores_holds(make_ami, load_tool, tmp_path, monkeypatch):
+    # cron mode has never looked at the holds, only the daemon does
+    fake = make_ami("scheduler", scheduler={'lockdir': 'var', 'tasks': ['hcpcli']})
+    scheduler = load_tool("scheduler", fake)
+    (tmp_path / "var").mkdir()
+    (tmp_path / "var" / "hcpcli.hold").touch()
+    started = []
+    monkeypatch.setattr(scheduler.subprocess, "Popen", lambda cmd, **kw: started.append(cmd))
+    with pytest.raises(SystemExit):
+        scheduler.schedule(None, False)
+    assert [cmd[-1] for cmd in started] == ['hcpcli']
@@ -0,0 +1,101 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+import pytest
+from ami.switchyard import Switchyard
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Answers from the server's script: a dict of path -> list of
+       (status, delay) for successive requests, the last one repeating"""
+    def handle_one(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path, self.headers.get('api-token')))
+            script = server.script.get(self.path, [(200, 0)])
+            count = sum(1 for r in server.requests if r[1] == self.path)
+            status, delay = script[min(count, len(script)) - 1]
+        if self.command == "POST":
+            self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(delay)
+        body = json.dumps({'error': False, 'status': 'deposited', 'message': '',
+                           'avalon_url': 'http://avalon' + self.path}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = handle_one
+    do_POST = handle_one
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    s = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    s.lock = threading.Lock()
+    s.requests = []
+    s.script = {}
+    threading.Thread(target=s.serve_forever, daemon=True).start()
+    yield s
+    s.shutdown()
+    s.server_close()
+
+
+def client(server, **kwargs):
+    return Switchyard(f"http://127.0.0.1:{server.server_address[1]}", "token",
+                      retry_time=0.01, **kwargs)
+
+
+def test_status(server):
+    sy = client(server)
+    assert sy.get_processing_status("g1")['avalon_url'] == "http://avalon/media_objects/status/g1"
+    assert server.requests == [("GET", "/media_objects/status/g1", "token")]
+
+
+def test_server_errors_are_retried(server):
+    server.script["/media_objects/status/g1"] = [(503, 0), (429, 0), (200, 0)]
+    sy = client(server)
+    assert sy.get_processing_status("g1")['status'] == 'deposited'
+    assert len(server.requests) == 3
+    assert sy.latency_summary()['GET']['count'] == 3
+
+
+def test_client_errors_are_not_retried(server):
+    server.script["/media_objects/create"] = [(422, 0)]
+    with pytest.raises(IOError):
+        client(server).submit_group("g1", {'x': 1})
+    assert len(server.requests) == 1
+
+
+def test_retries_give_up(server):
+    server.script["/media_objects/status/g1"] = [(500, 0)]
+    with pytest.raises(IOError):
+        client(server, retries=2).get_processing_status("g1")
+    assert len(server.requests) == 3
+
+
+def test_timeouts_are_retried_for_gets_only(server):
+    server.script["/media_objects/status/g1"] = [(200, 0.5), (200, 0)]
+    server.script["/media_objects/create"] = [(200, 0.5), (200, 0)]
+    sy = client(server, timeout=0.2)
+    assert sy.get_processing_status("g1")['status'] == 'deposited'
+    with pytest.raises(IOError):
+        sy.submit_group("g1", {'x': 1})
+    assert [r[0] for r in server.requests] == ["GET", "GET", "POST"]
+
+
+def test_concurrent_polling(server):
+    for g in ("g1", "g2", "g3", "g4"):
+        server.script[f"/media_objects/status/{g}"] = [(200, 0.3)]
+    server.script["/media_objects/status/bad"] = [(404, 0)]
+    sy = client(server, max_connections=4)
+    start = time.time()
+    results = sy.get_processing_statuses(["g1", "g2", "g3", "g4", "bad"])
+    assert time.time() - start < 1.0
+    assert all(results[g]['status'] == 'deposited' for g in ("g1", "g2", "g3", "g4"))
+    assert isinstance(results["bad"], IOError)
@@ -0,0 +1,142 @@
+from pathlib import Path
+import threading
+import time
+from ami.transcode import split_filter_chain, multi_rendition_args, default_streams, TranscodeScheduler
+
+
+class Jobs:
+    "Jobs which record their thread budgets and wait for the gate to open"
+    def __init__(self):
+        self.gate = threading.Event()
+        self.started = []
+        self.lock = threading.Lock()
+
+    def job(self, name, threads):
+        with self.lock:
+            self.started.append((name, threads))
+        assert self.gate.wait(10)
+        return name
+
+    def wait_for(self, count):
+        deadline = time.time() + 10
+        while len(self.started) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return list(self.started)
+
+
+def test_filter_chain_keeps_escaped_and_quoted_commas():
+    chain = r"yadif,scale=w='min(1280\,iw)':h=-2,drawtext=text='a, b',fps=30"
+    assert split_filter_chain(chain) == ['yadif', r"scale=w='min(1280\,iw)':h=-2", "drawtext=text='a, b'", 'fps=30']
+    assert split_filter_chain(r"select=eq(n\,0),null") == [r"select=eq(n\,0)", 'null']
+
+
+def test_multi_rendition_graph_keeps_filter_arguments():
+    renditions = {'high': (['-vf', r"yadif,scale=w='min(1280\,iw)':h=-2", '-c:v', 'libx264'], Path("high.mp4")),
+                  'low': (['-vf', "yadif,scale=640:-2", '-c:v', 'libx264'], Path("low.mp4"))}
+    cmd = multi_rendition_args(Path("in.mkv"), renditions, video_stream=0, audio_stream=1)
+    graph = cmd[cmd.index('-filter_complex') + 1]
+    assert graph == r"[0:0]yadif,split=2[s0][s1];[s0]scale=w='min(1280\,iw)':h=-2[v0];[s1]scale=640:-2[v1]"
+
+
+def test_default_streams_are_the_ones_ffmpeg_picks():
+    streams = [{'index': 0, 'codec_type': 'video', 'width': 640, 'height': 480},
+               {'index': 1, 'codec_type': 'audio', 'channels': 1},
+               {'index': 2, 'codec_type': 'video', 'width': 1920, 'height': 1080},
+               {'index': 3, 'codec_type': 'audio', 'channels': 2},
+               {'index': 4, 'codec_type': 'audio', 'channels': 2},
+               {'index': 5, 'codec_type': 'video', 'width': 3000, 'height': 3000, 'disposition': {'attached_pic': 1}}]
+    assert default_streams(streams) == (2, 3)
+    streams[4]['disposition'] = {'default': 1}
+    assert default_streams(streams) == (2, 4)
+    assert default_streams([{'index': 0, 'codec_type': 'audio', 'channels': 2}]) == (None, 0)
+
+
+def maps(cmd, outfile):
+    "The -map options for an output"
+    end = cmd.index(outfile)
+    start = max([i + 1 for i, a in enumerate(cmd[:end]) if a.endswith(".mp4")] + [cmd.index('-i') + 2])
+    return [cmd[i + 1] for i in range(start, end) if cmd[i] == '-map']
+
+
+def test_renditions_use_the_streams_ffmpeg_would_pick():
+    video = ['-c:v', 'libx264', '-c:a', 'aac']
+    audio = ['-vn', '-c:a', 'aac']
+    mapped = ['-map', '0:1', '-c:a', 'aac']
+    cmd = multi_rendition_args(Path("in.mkv"), {'high': (video, Path("high.mp4")),
+                                                'audio': (audio, Path("audio.mp4")),
+                                                'mapped': (mapped, Path("mapped.mp4"))},
+                               video_stream=2, audio_stream=3)
+    assert cmd[cmd.index('-filter_complex') + 1].startswith("[0:2]")
+    assert maps(cmd, "high.mp4") == ['[v0]', '0:3']
+    # these are left to ffmpeg, just like when they're made one at a time
+    assert maps(cmd, "audio.mp4") == []
+    assert maps(cmd, "mapped.mp4") == ['0:1']
+    # a source without audio
+    cmd = multi_rendition_args(Path("in.mkv"), {'high': (video, Path("high.mp4"))}, video_stream=0)
+    assert maps(cmd, "high.mp4") == ['[v0]']
+
+
+def test_scheduler_splits_the_free_cores():
+    jobs = Jobs()
+    with TranscodeScheduler(cores=8, max_jobs=3) as ts:
+        futures = ts.submit_many([(10, jobs.job, ('small',), {}),
+                                  (30, jobs.job, ('large',), {}),
+                                  (20, jobs.job, ('medium',), {})])
+        # an even share of the free cores among the jobs which can start
+        assert sorted(jobs.wait_for(3)) == [('large', 2), ('medium', 3), ('small', 3)]
+        assert ts.free == 0
+        jobs.gate.set()
+    assert [f.result() for f in futures] == ['small', 'large', 'medium']
+    assert ts.free == 8 and ts.running == 0
+
+
+def test_scheduler_starts_the_most_expensive_first():
+    jobs = Jobs()
+    with TranscodeScheduler(cores=4, max_jobs=1) as ts:
+        ts.submit(1, jobs.job, 'first')
+        assert jobs.wait_for(1) == [('first', 4)]
+        ts.submit_many([(5, jobs.job, ('cheap',), {}),
+                        (50, jobs.job, ('dear',), {}),
+                        (10, jobs.job, ('middling',), {})])
+        jobs.gate.set()
+    assert [x[0] for x in jobs.started] == ['first', 'dear', 'middling', 'cheap']
+
+
+def test_scheduler_caps_the_threads():
+    jobs = Jobs()
+    jobs.gate.set()
+    with TranscodeScheduler(cores=16, max_threads=3) as ts:
+        assert ts.submit(1, jobs.job, 'only').result() == 'only'
+    assert jobs.started == [('only', 3)]
+
+
+def test_cancelled_jobs_never_run():
+    jobs = Jobs()
+    with TranscodeScheduler(cores=2, max_jobs=1) as ts:
+        running = ts.submit(1, jobs.job, 'running')
+        jobs.wait_for(1)
+        queued = ts.submit(1, jobs.job, 'queued')
+        assert queued.cancel()
+        # a running job can't be cancelled
+        assert not running.cancel()
+        jobs.gate.set()
+    assert queued.cancelled()
+    assert running.result() == 'running'
+    assert jobs.started == [('running', 2)]
+
+
+def test_shutdown_waits_for_queued_jobs():
+    done = []
+
+    def job(name, threads):
+        time.sleep(0.05)
+        done.append(name)
+        if name == 'broken':
+            raise ValueError(name)
+
+    ts = TranscodeScheduler(cores=2, max_jobs=1)
+    futures = [ts.submit(1, job, name) for name in ('a', 'broken', 'c')]
+    ts.shutdown()
+    assert sorted(done) == ['a', 'broken', 'c']
+    assert all(f.done() for f in futures)
+    assert isinstance(futures[1].exception(), ValueError)